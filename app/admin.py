@@ -1,4 +1,4 @@
-from app.models import RipplingGroup, RipplingEmployee, RipplingCompany
+from app.models import RipplingGroup, RipplingEmployee, RipplingCompany, RipplingWebhookEvent
 from django.contrib import admin
 
 
@@ -21,4 +21,11 @@ class RipplingGroupAdmin(admin.ModelAdmin):
 	list_display = ['id', 'company', 'name', 'created_at', 'updated_at']
 	read_only_fields = ['created_at', 'updated_at']
 	pass
-admin.site.register(RipplingGroup, RipplingGroupAdmin)
\ No newline at end of file
+admin.site.register(RipplingGroup, RipplingGroupAdmin)
+
+class RipplingWebhookEventAdmin(admin.ModelAdmin):
+	list_display = ['id', 'event_name', 'company_id', 'object_id', 'status', 'attempts', 'available_at', 'created_at', 'processed_at']
+	list_filter = ['status', 'event_name']
+	read_only_fields = ['created_at']
+	pass
+admin.site.register(RipplingWebhookEvent, RipplingWebhookEventAdmin)
\ No newline at end of file
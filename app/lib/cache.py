@@ -0,0 +1,151 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.utils import timezone
+
+from app.models import RipplingCompany
+
+
+class GroupSnapshot:
+
+    def __init__(self, groups, fetched_at):
+        self.groups = groups
+        self.fetched_at = fetched_at
+        self.expires = time.monotonic() + settings.RIPPLING_GROUP_CACHE_TTL
+
+
+class GroupSnapshotCache:
+    """
+    Per-company snapshot of every group, indexed by group id.
+
+    One fetch serves a whole burst of group events: a snapshot is reused
+    while it is younger than RIPPLING_GROUP_CACHE_TTL and was fetched after
+    the event being handled was received. Concurrent misses for the same
+    company wait on a single fetch.
+    """
+
+    def __init__(self, max_companies=None):
+        self.max_companies = max_companies or settings.RIPPLING_GROUP_CACHE_MAX_COMPANIES
+        self._snapshots = OrderedDict()
+        self._lock = threading.Lock()
+        self._fetch_locks = {}
+
+    def _fresh(self, company_id, fresh_after):
+        with self._lock:
+            snapshot = self._snapshots.get(company_id)
+            if snapshot is None or snapshot.expires < time.monotonic():
+                return None
+            if fresh_after and snapshot.fetched_at < fresh_after:
+                return None
+            self._snapshots.move_to_end(company_id)
+            return snapshot
+
+    def _fetch_lock(self, company_id):
+        with self._lock:
+            return self._fetch_locks.setdefault(company_id, threading.Lock())
+
+    def get(self, company_id, group_id, fetch, fresh_after=None):
+        """
+        Return the group payload for `group_id`, calling `fetch()` for an
+        iterable of every group of the company when no usable snapshot
+        exists. A group missing from a cached snapshot triggers one refetch.
+        """
+        snapshot = self._fresh(company_id, fresh_after)
+        if snapshot is not None and group_id in snapshot.groups:
+            return snapshot.groups[group_id]
+
+        stale = snapshot
+        with self._fetch_lock(company_id):
+            snapshot = self._fresh(company_id, fresh_after)
+            if snapshot is None or snapshot is stale:
+                snapshot = self._fetch(company_id, fetch)
+        return snapshot.groups.get(group_id)
+
+    def _fetch(self, company_id, fetch):
+        fetched_at = timezone.now()
+        groups = {group.get('id'): group for group in fetch() or []}
+        snapshot = GroupSnapshot(groups, fetched_at)
+        with self._lock:
+            self._snapshots[company_id] = snapshot
+            self._snapshots.move_to_end(company_id)
+            while len(self._snapshots) > self.max_companies:
+                evicted, _ = self._snapshots.popitem(last=False)
+                self._fetch_locks.pop(evicted, None)
+        return snapshot
+
+    def invalidate(self, company_id, group_id=None):
+        with self._lock:
+            if group_id is None:
+                self._snapshots.pop(company_id, None)
+            elif company_id in self._snapshots:
+                self._snapshots[company_id].groups.pop(group_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._snapshots.clear()
+
+
+class CompanyResolver:
+    """
+    Bounded LRU of RipplingCompany rows keyed by Rippling company id.
+
+    A cached company costs no queries to resolve, and primary_email is only
+    written when the incoming value differs from the stored one. Entries
+    expire after RIPPLING_COMPANY_CACHE_TTL seconds so that changes made by
+    other processes are picked up, and company events invalidate them.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size or settings.RIPPLING_COMPANY_CACHE_SIZE
+        self._companies = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, company_id):
+        with self._lock:
+            entry = self._companies.get(company_id)
+            if entry is None:
+                return None
+            company, expires = entry
+            if expires < time.monotonic():
+                del self._companies[company_id]
+                return None
+            self._companies.move_to_end(company_id)
+            return company
+
+    def _put(self, company_id, company):
+        with self._lock:
+            self._companies[company_id] = (company, time.monotonic() + settings.RIPPLING_COMPANY_CACHE_TTL)
+            self._companies.move_to_end(company_id)
+            while len(self._companies) > self.max_size:
+                self._companies.popitem(last=False)
+
+    def resolve(self, company_id, primary_email=None):
+        """
+        Return the RipplingCompany for `company_id`, creating it if needed and
+        updating primary_email when it changed.
+        """
+        company = self._get(company_id)
+        if company is None:
+            company = RipplingCompany.objects.filter(company_id=company_id).first()
+            if company is None:
+                company = RipplingCompany.objects.upsert(company_id=company_id, defaults={'primary_email': primary_email})
+            self._put(company_id, company)
+
+        if primary_email and company.primary_email != primary_email:
+            RipplingCompany.objects.filter(pk=company.pk).update(primary_email=primary_email)
+            company.primary_email = primary_email
+        return company
+
+    def invalidate(self, company_id):
+        with self._lock:
+            self._companies.pop(company_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._companies.clear()
+
+
+group_snapshots = GroupSnapshotCache()
+companies = CompanyResolver()
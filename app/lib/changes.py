@@ -0,0 +1,46 @@
+from app.models import RipplingEmployee, RipplingGroup
+
+# fields carrying Rippling's own record version, when they match the stored
+# row nothing else needs comparing
+VERSION_FIELDS = {
+    RipplingEmployee: 'updated_at',
+    RipplingGroup: 'version',
+}
+
+
+def diff_fields(instance, values):
+    """
+    Return the subset of `values` that differs from what `instance` holds.
+    """
+    return {field: value for field, value in values.items() if getattr(instance, field) != value}
+
+
+def is_same_version(model, instance, values):
+    version_field = VERSION_FIELDS.get(model)
+    if not version_field or values.get(version_field) is None:
+        return False
+    return getattr(instance, version_field) == values[version_field]
+
+
+def save_changes(model, lookup, values):
+    """
+    Write `values` to the row matching `lookup`, touching only what changed.
+
+    A missing row is inserted with a single upsert. An existing row is left
+    alone when its Rippling version matches or no field differs, otherwise
+    only the differing columns are updated. Returns the instance and the
+    names of the fields that were written.
+    """
+    instance = model.objects.filter(**lookup).first()
+    if instance is None:
+        return model.objects.upsert(defaults=values, **lookup), list(values)
+
+    if is_same_version(model, instance, values):
+        return instance, []
+
+    changed = diff_fields(instance, values)
+    if changed:
+        model.objects.filter(pk=instance.pk).update(**changed)
+        for field, value in changed.items():
+            setattr(instance, field, value)
+    return instance, list(changed)
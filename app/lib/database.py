@@ -0,0 +1,14 @@
+from django.conf import settings
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    """
+    Apply the journal, synchronous and busy timeout pragmas to every new
+    SQLite connection.
+    """
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'PRAGMA journal_mode={settings.SQLITE_JOURNAL_MODE}')
+        cursor.execute(f'PRAGMA synchronous={settings.SQLITE_SYNCHRONOUS}')
+        cursor.execute(f'PRAGMA busy_timeout={int(settings.SQLITE_BUSY_TIMEOUT)}')
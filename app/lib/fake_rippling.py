@@ -0,0 +1,175 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+class FakeRipplingDirectory:
+    """
+    Deterministic companies, employees and groups served by the fake API.
+
+    Company `c` has employees `c-e000000`... and groups `c-g0000`..., group
+    `n` containing every employee whose index is congruent to `n` modulo the
+    number of groups. Authorization codes and access tokens name the company
+    and employee they were issued for: `<company>:<employee index>`.
+    """
+
+    def __init__(self, companies=1, employees=100, groups=10):
+        self.company_ids = [f'company{index:04d}' for index in range(companies)]
+        self.employees = employees
+        self.groups = groups
+
+    def employee_id(self, company_id, index):
+        return f'{company_id}-e{index:06d}'
+
+    def group_id(self, company_id, index):
+        return f'{company_id}-g{index:04d}'
+
+    def code(self, company_id, index=0):
+        return f'{company_id}:{index}'
+
+    def employee(self, company_id, index):
+        employee_id = self.employee_id(company_id, index)
+        return {
+            'id': employee_id,
+            'firstName': f'Given{index}',
+            'lastName': f'Family{index}',
+            'workEmail': f'{employee_id}@example.com',
+            'createdAt': '2023-01-01T00:00:00Z',
+            'updatedAt': '2024-01-01T00:00:00Z',
+        }
+
+    def group(self, company_id, index):
+        return {
+            'id': self.group_id(company_id, index),
+            'name': f'Group {index}',
+            'users': [self.employee_id(company_id, member) for member in range(index, self.employees, self.groups)],
+            'version': 'v1',
+        }
+
+    def company(self, company_id):
+        return {'id': company_id, 'name': f'Company {company_id}', 'primaryEmail': f'admin@{company_id}.example.com'}
+
+    def user_info(self, company_id, index):
+        employee = self.employee(company_id, index)
+        return {
+            'sub': employee['id'],
+            'given_name': employee['firstName'],
+            'family_name': employee['lastName'],
+            'name': f'{employee["firstName"]} {employee["lastName"]}',
+            'email': employee['workEmail'],
+            'company_id': company_id,
+        }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _principal(self):
+        token = self.headers.get('Authorization', '').removeprefix('Bearer ')
+        company_id, _, index = token.removeprefix('token:').partition(':')
+        if company_id not in self.server.directory.company_ids:
+            return None, None
+        return company_id, int(index or 0)
+
+    def _page(self, query, records):
+        limit = int(query.get('limit', [len(records)])[0])
+        offset = int(query.get('offset', [0])[0])
+        return records[offset:offset + limit]
+
+    def do_GET(self):
+        self.server.hit()
+        directory = self.server.directory
+        parts = urlsplit(self.path)
+        path = parts.path.rstrip('/')
+        query = parse_qs(parts.query)
+        company_id, index = self._principal()
+        if company_id is None:
+            return self._send(401, {'detail': 'Invalid token'})
+
+        if path == '/platform/api/employees':
+            employees = [directory.employee(company_id, i) for i in range(directory.employees)]
+            return self._send(200, self._page(query, employees))
+        if path.startswith('/platform/api/employees/'):
+            employee_id = path.rsplit('/', 1)[1]
+            prefix = f'{company_id}-e'
+            if employee_id.startswith(prefix) and int(employee_id[len(prefix):]) < directory.employees:
+                return self._send(200, directory.employee(company_id, int(employee_id[len(prefix):])))
+            return self._send(404, {'detail': 'Not found'})
+        if path == '/platform/api/groups':
+            groups = [directory.group(company_id, i) for i in range(directory.groups)]
+            return self._send(200, self._page(query, groups))
+        if path == '/platform/api/me':
+            employee = directory.employee(company_id, index)
+            return self._send(200, {'id': employee['id'], 'company': company_id, 'workEmail': employee['workEmail']})
+        if path == '/platform/api/userinfo':
+            return self._send(200, directory.user_info(company_id, index))
+        if path == '/platform/api/companies/current':
+            return self._send(200, directory.company(company_id))
+        return self._send(404, {'detail': 'Not found'})
+
+    def do_POST(self):
+        self.server.hit()
+        length = int(self.headers.get('Content-Length') or 0)
+        form = parse_qs(self.rfile.read(length).decode('utf-8'))
+        if urlsplit(self.path).path != '/api/o/token/':
+            return self._send(404, {'detail': 'Not found'})
+        grant = form.get('code') or form.get('refresh_token') or ['']
+        principal = grant[0].removeprefix('token:').removeprefix('refresh:')
+        return self._send(200, {
+            'access_token': f'token:{principal}',
+            'refresh_token': f'refresh:{principal}',
+            'expires_in': 3600,
+            'scope': 'employees:read groups:read',
+            'token_type': 'Bearer',
+        })
+
+
+class FakeRipplingServer(ThreadingHTTPServer):
+    """
+    Local stand-in for the Rippling API, run on a background thread. Every
+    response is delayed by `latency` seconds.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, directory, latency=0.0, host='127.0.0.1', port=0):
+        super().__init__((host, port), _Handler)
+        self.directory = directory
+        self.latency = latency
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def hit(self):
+        with self._lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='fake-rippling', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,113 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from app.models import RipplingWebhookReceipt
+
+
+def event_key(event_name, delivery_id):
+    """
+    Identity of a webhook delivery, shared by redeliveries of one event.
+    """
+    identity = '\x1f'.join([event_name or '', delivery_id])
+    return hashlib.sha256(identity.encode('utf-8')).hexdigest()
+
+
+class IdempotencyStore:
+    """
+    Remembers which webhook deliveries were already accepted.
+
+    Keys are recorded in the RipplingWebhookReceipt table, whose unique
+    constraint makes the first insert win across processes. A bounded LRU in
+    front of it answers repeated redeliveries to the same process without a
+    query. Receipts older than RIPPLING_WEBHOOK_DEDUP_TTL no longer count and
+    are purged by claim() at most once per TTL.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size or settings.RIPPLING_WEBHOOK_DEDUP_CACHE_SIZE
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+        self._purged = time.monotonic()
+
+    def _seen(self, key):
+        with self._lock:
+            expires = self._keys.get(key)
+            if expires is None:
+                return False
+            if expires < time.monotonic():
+                del self._keys[key]
+                return False
+            self._keys.move_to_end(key)
+            return True
+
+    def _remember(self, key):
+        with self._lock:
+            self._keys[key] = time.monotonic() + settings.RIPPLING_WEBHOOK_DEDUP_TTL
+            self._keys.move_to_end(key)
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+
+    def claim(self, key):
+        """
+        Record `key` and return True if it was not received within the TTL,
+        False for a duplicate.
+        """
+        if self._seen(key):
+            return False
+
+        now = timezone.now()
+        try:
+            with transaction.atomic():
+                RipplingWebhookReceipt.objects.create(key=key, received_at=now)
+            claimed = True
+        except IntegrityError:
+            # an expired receipt is taken over, a live one is a duplicate
+            cutoff = now - timedelta(seconds=settings.RIPPLING_WEBHOOK_DEDUP_TTL)
+            claimed = bool(RipplingWebhookReceipt.objects.filter(key=key, received_at__lt=cutoff).update(received_at=now))
+
+        if claimed:
+            # only remember a new receipt once it is committed
+            transaction.on_commit(lambda: self._remember(key))
+            self._purge_expired()
+        else:
+            self._remember(key)
+        return claimed
+
+    def _purge_expired(self):
+        with self._lock:
+            if time.monotonic() - self._purged < settings.RIPPLING_WEBHOOK_DEDUP_TTL:
+                return
+            self._purged = time.monotonic()
+        purge_receipts()
+
+    def release(self, key):
+        """
+        Forget `key`, so that a redelivery of an event that failed to be
+        handled is accepted again.
+        """
+        with self._lock:
+            self._keys.pop(key, None)
+        RipplingWebhookReceipt.objects.filter(key=key).delete()
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+
+
+def purge_receipts(older_than=None):
+    """
+    Delete receipts that are past the deduplication TTL.
+    """
+    older_than = older_than or settings.RIPPLING_WEBHOOK_DEDUP_TTL
+    cutoff = timezone.now() - timedelta(seconds=older_than)
+    return RipplingWebhookReceipt.objects.filter(received_at__lt=cutoff).delete()[0]
+
+
+receipts = IdempotencyStore()
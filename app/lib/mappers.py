@@ -0,0 +1,76 @@
+import json
+
+from django.utils.dateparse import parse_datetime
+
+# created_at is only written on insert and by change detection, bulk updates
+# leave it alone since Rippling never changes it
+EMPLOYEE_FIELDS = ['given_name', 'family_name', 'email', 'updated_at']
+GROUP_FIELDS = ['name', 'users', 'version']
+INSTALL_COMPANY_FIELDS = ['company_name', 'primary_email', 'access_token', 'refresh_token', 'expires_in', 'expires_at', 'scope']
+
+
+def _parse_datetime(value):
+    if not value:
+        return None
+    try:
+        return parse_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def employee_values(employee_data):
+    """
+    Map a Rippling employee payload onto RipplingEmployee field values.
+    created_at and updated_at are left out when the payload carries no
+    usable createdAt or updatedAt.
+    """
+    values = {
+        'given_name': employee_data.get('firstName'),
+        'family_name': employee_data.get('lastName'),
+        'email': employee_data.get('workEmail'),
+    }
+    created_at = _parse_datetime(employee_data.get('createdAt'))
+    if created_at:
+        values['created_at'] = created_at
+    updated_at = _parse_datetime(employee_data.get('updatedAt'))
+    if updated_at:
+        values['updated_at'] = updated_at
+    return values
+
+
+def group_values(group_data):
+    """
+    Map a Rippling group payload onto RipplingGroup field values.
+    """
+    return {
+        'name': group_data.get('name'),
+        'users': group_data.get('users') or [],
+        'version': group_data.get('version'),
+    }
+
+
+def user_info_values(user_info):
+    """
+    Map an OpenID userinfo payload onto RipplingEmployee field values.
+    """
+    address = user_info.get('address') or {}
+    if isinstance(address, str):
+        address = json.loads(address)
+    return {
+        'role_id': user_info.get('role_id'),
+        'picture': user_info.get('picture'),
+        'name': user_info.get('name'),
+        'family_name': user_info.get('family_name'),
+        'given_name': user_info.get('given_name'),
+        'birthdate': user_info.get('birthdate') or None,
+        'gender': user_info.get('gender'),
+        'email': user_info.get('email'),
+        'email_verified': bool(user_info.get('email_verified')),
+        'street_address': address.get('street_address'),
+        'locality': address.get('locality'),
+        'region': address.get('region'),
+        'postal_code': address.get('postal_code'),
+        'country': address.get('country'),
+        'phone_number': user_info.get('phone_number'),
+        'phone_number_verified': bool(user_info.get('phone_number_verified')),
+    }
@@ -0,0 +1,49 @@
+from collections import defaultdict
+
+from app.models import RipplingGroup, RipplingGroupMembership
+
+
+def sync_memberships(company_id, group_users):
+    """
+    Bring the membership rows of several groups in line with their user
+    lists, given as {group pk: [employee ids]}.
+
+    Current members are read in one query, then removed and added members
+    are written with one bulk delete and one bulk insert. Returns the number
+    of added and removed memberships.
+    """
+    if not group_users:
+        return 0, 0
+
+    current = defaultdict(dict)
+    rows = RipplingGroupMembership.objects.filter(group_id__in=list(group_users)).values_list('pk', 'group_id', 'employee_id')
+    for pk, group_id, employee_id in rows:
+        current[group_id][employee_id] = pk
+
+    to_add = []
+    to_remove = []
+    for group_id, users in group_users.items():
+        wanted = set(users or [])
+        members = current[group_id]
+        for employee_id in wanted.difference(members):
+            to_add.append(RipplingGroupMembership(company_id=company_id, group_id=group_id, employee_id=employee_id))
+        for employee_id in set(members).difference(wanted):
+            to_remove.append(members[employee_id])
+
+    if to_remove:
+        RipplingGroupMembership.objects.filter(pk__in=to_remove).delete()
+    if to_add:
+        RipplingGroupMembership.objects.bulk_create(to_add, ignore_conflicts=True)
+    return len(to_add), len(to_remove)
+
+
+def sync_group_members(group, users):
+    return sync_memberships(group.company_id, {group.pk: users})
+
+
+def group_memberships(group):
+    return RipplingGroupMembership.objects.filter(group=group)
+
+
+def employee_groups(company, employee_id):
+    return RipplingGroup.objects.filter(company=company, memberships__employee_id=employee_id)
@@ -0,0 +1,231 @@
+import functools
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from django.db import connection
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 250)
+
+
+class Registry:
+    """
+    Process-wide metric registry.
+
+    Every thread writes to its own shard, a plain dict only that thread
+    mutates, so recording a sample takes no lock. Shards are summed when
+    the metrics are collected, and the shards of finished threads are
+    folded into a shared total so that thread-per-request servers do not
+    accumulate them.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self._shards = {}
+        self._retired = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._retire_dead_shards()
+                self._shards[threading.current_thread()] = shard
+        return shard
+
+    def _retire_dead_shards(self):
+        # a finished thread no longer writes to its shard, so it can be
+        # merged without racing it; called with the lock held
+        for thread in [thread for thread in self._shards if not thread.is_alive()]:
+            for key, value in self._shards.pop(thread).items():
+                self._retired[key] = self.metrics[key[0]].merge(self._retired.get(key), value)
+
+    def register(self, metric):
+        with self._lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def collect(self, metric):
+        with self._lock:
+            self._retire_dead_shards()
+            shards = list(self._shards.values())
+            totals = {labels: metric.merge(None, value) for (name, labels), value in self._retired.items() if name == metric.name}
+        for shard in shards:
+            for (name, labels), value in list(shard.items()):
+                if name == metric.name:
+                    totals[labels] = metric.merge(totals.get(labels), value)
+        return totals
+
+    def render(self):
+        """
+        Return every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in sorted(self.metrics.values(), key=lambda metric: metric.name):
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for labels, value in sorted(self.collect(metric).items()):
+                lines.extend(metric.samples(labels, value))
+        return '\n'.join(lines) + '\n'
+
+
+def _key(name, labelnames, labels):
+    # label values are rendered as text anyway, and strings keep mixed values
+    # such as status 200 and 'error' sortable
+    return (name, tuple((labelname, str(labels[labelname])) for labelname in labelnames))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.registry = registry or REGISTRY
+        self.registry.register(self)
+
+    def inc(self, amount=1, **labels):
+        key = _key(self.name, self.labelnames, labels)
+        shard = self.registry.shard()
+        shard[key] = shard.get(key, 0) + amount
+
+    def merge(self, total, value):
+        return (total or 0) + value
+
+    def samples(self, labels, value):
+        return [f'{self.name}{_format_labels(labels)} {_format_value(value)}']
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.registry = registry or REGISTRY
+        self.registry.register(self)
+
+    def observe(self, value, **labels):
+        key = _key(self.name, self.labelnames, labels)
+        shard = self.registry.shard()
+        state = shard.get(key)
+        if state is None:
+            # per-bucket counts, then the total count and sum
+            state = shard[key] = [0] * (len(self.buckets) + 2)
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[index] += 1
+                break
+        state[-2] += 1
+        state[-1] += value
+
+    def merge(self, total, value):
+        if total is None:
+            return list(value)
+        return [a + b for a, b in zip(total, value)]
+
+    def samples(self, labels, value):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, value):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{_format_labels(labels, [("le", _format_value(float(bound)))])} {cumulative}')
+        lines.append(f'{self.name}_bucket{_format_labels(labels, [("le", "+Inf")])} {value[-2]}')
+        lines.append(f'{self.name}_count{_format_labels(labels)} {value[-2]}')
+        lines.append(f'{self.name}_sum{_format_labels(labels)} {_format_value(float(value[-1]))}')
+        return lines
+
+
+REGISTRY = Registry()
+
+api_requests = Counter(
+    'rippling_api_requests_total', 'Requests sent to the Rippling API.', ['method', 'endpoint', 'status'],
+)
+api_duration = Histogram(
+    'rippling_api_request_duration_seconds', 'Latency of Rippling API requests.', ['method', 'endpoint'],
+)
+api_response_bytes = Counter(
+    'rippling_api_response_bytes_total', 'Bytes received from the Rippling API.', ['method', 'endpoint'],
+)
+api_retries = Counter(
+    'rippling_api_retries_total', 'Rippling API requests that were retried.', ['method', 'endpoint', 'reason'],
+)
+webhook_events = Counter(
+    'rippling_webhook_events_total', 'Webhook events handled.', ['event', 'outcome'],
+)
+webhook_duration = Histogram(
+    'rippling_webhook_duration_seconds', 'Time spent handling a webhook event.', ['event'],
+)
+webhook_queries = Histogram(
+    'rippling_webhook_db_queries', 'Database queries run while handling a webhook event.', ['event'], buckets=QUERY_BUCKETS,
+)
+view_duration = Histogram(
+    'app_view_duration_seconds', 'Latency of the app views.', ['view', 'method', 'status'],
+)
+
+_ID_SEGMENT = re.compile(r'^(?=.*\d)[\w-]{8,}$')
+
+
+def endpoint_label(url):
+    """
+    Path of a Rippling URL with object ids replaced, so that every employee
+    lookup shares one label.
+    """
+    path = re.sub(r'^https?://[^/]+', '', url).split('?', 1)[0]
+    return '/'.join(':id' if _ID_SEGMENT.match(segment) else segment for segment in path.split('/'))
+
+
+class QueryCounter:
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+@contextmanager
+def count_queries():
+    """
+    Count the queries run on the default connection of this thread within
+    the block.
+    """
+    counter = QueryCounter()
+    with connection.execute_wrapper(counter):
+        yield counter
+
+
+def observe_view(view):
+    """
+    Record the latency of a view, labelled by view name, method and status.
+    """
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = view(request, *args, **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            view_duration.observe(time.perf_counter() - start, view=view.__name__, method=request.method, status=status)
+    return wrapper
@@ -0,0 +1,115 @@
+import contextvars
+import cProfile
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar('rippling_profile', default=None)
+
+
+class Profile:
+
+    def __init__(self):
+        self.db_queries = 0
+        self.db_time = 0.0
+        self.http_requests = 0
+        self.http_time = 0.0
+        self.wall_time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_queries += 1
+            self.db_time += time.perf_counter() - start
+
+    def __str__(self):
+        return (
+            f'wall={self.wall_time * 1000:.1f}ms db={self.db_queries} queries/{self.db_time * 1000:.1f}ms '
+            f'http={self.http_requests} requests/{self.http_time * 1000:.1f}ms'
+        )
+
+
+@contextmanager
+def profile():
+    """
+    Record wall time, queries on this thread's default connection and
+    Rippling HTTP requests made within the block, including requests sent
+    from RipplingIntegration.submit().
+    """
+    current = Profile()
+    token = _current.set(current)
+    start = time.perf_counter()
+    try:
+        with connection.execute_wrapper(current):
+            yield current
+    finally:
+        current.wall_time = time.perf_counter() - start
+        _current.reset(token)
+
+
+def record_http(duration):
+    current = _current.get()
+    if current is not None:
+        current.http_requests += 1
+        current.http_time += duration
+
+
+class ProfilingMiddleware:
+    """
+    Profile requests to the app views and log the ones over budget.
+
+    Enabled with PROFILING_ENABLED. When PROFILING_CPROFILE_DIR is set, a
+    cProfile snapshot of every request slower than
+    PROFILING_MAX_DURATION is written there.
+    """
+
+    def __init__(self, get_response):
+        if not settings.PROFILING_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        profiler = cProfile.Profile() if settings.PROFILING_CPROFILE_DIR else None
+        with profile() as current:
+            if profiler:
+                profiler.enable()
+            try:
+                response = self.get_response(request)
+            finally:
+                if profiler:
+                    profiler.disable()
+
+        match = request.resolver_match
+        if match is None or not match.func.__module__.startswith('app.'):
+            return response
+
+        over = []
+        if current.db_queries > settings.PROFILING_MAX_QUERIES:
+            over.append('queries')
+        if current.http_requests > settings.PROFILING_MAX_HTTP_REQUESTS:
+            over.append('http requests')
+        if current.wall_time * 1000 > settings.PROFILING_MAX_DURATION:
+            over.append('duration')
+            if profiler:
+                self._dump(profiler, request)
+        if over:
+            logger.warning(f'{request.method} {request.path} over budget ({", ".join(over)}): {current}')
+        else:
+            logger.debug(f'{request.method} {request.path}: {current}')
+        return response
+
+    def _dump(self, profiler, request):
+        name = f'{time.strftime("%Y%m%d-%H%M%S")}-{request.method}-{request.path.strip("/").replace("/", "_") or "root"}-{os.getpid()}.prof'
+        path = os.path.join(settings.PROFILING_CPROFILE_DIR, name)
+        os.makedirs(settings.PROFILING_CPROFILE_DIR, exist_ok=True)
+        profiler.dump_stats(path)
+        logger.warning(f'Wrote profile of {request.method} {request.path} to {path}')
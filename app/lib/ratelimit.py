@@ -0,0 +1,184 @@
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+from django.conf import settings
+from django.utils import timezone
+
+from app.lib.transport import RipplingAPIError
+
+
+class RipplingRateLimitError(RipplingAPIError):
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message, status_code=429)
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value):
+    """
+    Return the delay in seconds requested by a Retry-After header, which is
+    either a number of seconds or an HTTP date.
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - timezone.now()).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """
+    Classic token bucket: `rate` requests per second with bursts of up to
+    `capacity`. pause() empties the bucket until a given time, which is how
+    a Retry-After from the API is honoured by every caller at once.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, max_wait=None):
+        """
+        Take a token, sleeping until one is available. Raises
+        RipplingRateLimitError instead when that would take longer than
+        `max_wait` seconds in total.
+        """
+        deadline = time.monotonic() + max_wait if max_wait is not None else None
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                raise RipplingRateLimitError(f'Rate limit wait of {wait:.1f}s exceeds {max_wait}s', retry_after=wait)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+class AdaptiveConcurrency:
+    """
+    Concurrency limit tuned by additive increase / multiplicative decrease:
+    every success raises the limit by 1/limit, every 429 or 5xx halves it.
+    """
+
+    def __init__(self, initial, minimum, maximum):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, timeout=None):
+        """
+        Wait for a free slot and take it. Returns False instead when none
+        frees up within `timeout` seconds.
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    def success(self):
+        with self._condition:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify()
+
+    def backoff(self):
+        with self._condition:
+            self.limit = max(self.minimum, self.limit / 2)
+
+
+class CompanyRateLimiter:
+
+    def __init__(self):
+        self.bucket = TokenBucket(settings.RIPPLING_RATE_LIMIT_RATE, settings.RIPPLING_RATE_LIMIT_BURST)
+        self.concurrency = AdaptiveConcurrency(
+            settings.RIPPLING_RATE_LIMIT_MAX_CONCURRENCY,
+            1,
+            settings.RIPPLING_RATE_LIMIT_MAX_CONCURRENCY,
+        )
+
+    @contextmanager
+    def slot(self, max_wait=None):
+        """
+        Hold a concurrency slot and a token for one request. Raises
+        RipplingRateLimitError when getting both would take longer than
+        `max_wait` seconds in total.
+        """
+        start = time.monotonic()
+        if not self.concurrency.acquire(max_wait):
+            raise RipplingRateLimitError(f'No request slot freed up within {max_wait}s', retry_after=max_wait)
+        try:
+            self.bucket.acquire(max(max_wait - (time.monotonic() - start), 0) if max_wait is not None else None)
+            yield
+        finally:
+            self.concurrency.release()
+
+    def record(self, status_code, retry_after=None):
+        if status_code == 429 or status_code >= 500:
+            self.concurrency.backoff()
+            if retry_after:
+                self.bucket.pause(retry_after)
+        else:
+            self.concurrency.success()
+
+
+class RateLimiterRegistry:
+    """
+    Bounded LRU of per-company limiters.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size or settings.RIPPLING_COMPANY_CACHE_SIZE
+        self._limiters = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            limiter = self._limiters.get(key)
+            if limiter is None:
+                limiter = self._limiters[key] = CompanyRateLimiter()
+                while len(self._limiters) > self.max_size:
+                    self._limiters.popitem(last=False)
+            self._limiters.move_to_end(key)
+            return limiter
+
+    def clear(self):
+        with self._lock:
+            self._limiters.clear()
+
+
+rate_limiters = RateLimiterRegistry()
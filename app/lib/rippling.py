@@ -1,9 +1,22 @@
+import contextvars
 import logging
+import threading
+import time
 from base64 import b64encode
+from concurrent.futures import Future
+from contextlib import contextmanager
 
 import requests
 from django.conf import settings
 
+from app.lib import metrics, profiling, transport
+from app.lib.cache import companies, group_snapshots
+from app.lib.changes import save_changes
+from app.lib.mappers import employee_values, group_values
+from app.lib.memberships import sync_group_members
+from app.lib.ratelimit import RipplingRateLimitError, parse_retry_after, rate_limiters
+from app.lib.tokens import access_tokens
+from app.lib.transport import RipplingAPIError
 from app.models import RipplingCompany, RipplingEmployee, RipplingGroup
 
 logger = logging.getLogger(__name__)
@@ -11,25 +24,48 @@ logger = logging.getLogger(__name__)
 
 class RipplingIntegration:
     access_token = None
+    # company whose rate limit budget requests are charged to
+    company_id = None
+    # when the webhook event being handled was received, used to decide
+    # whether a cached group snapshot is recent enough
+    event_received_at = None
 
     def __init__(self):
         self.client_id = settings.RIPPLING_CLIENT_ID
         self.client_secret = settings.RIPPLING_CLIENT_SECRET
         self.redirect_uri = settings.RIPPLING_REDIRECT_URI
         self.base_url = settings.RIPPLING_BASE_URL
+        self._memo = None
+        self._memo_lock = threading.Lock()
+
+    @contextmanager
+    def memoize(self):
+        """
+        Within the block, identical GETs made with the same credentials are sent
+        once and share their response, including calls made concurrently
+        through submit(). Meant to span a single request.
+        """
+        if self._memo is not None:
+            yield self
+            return
+        self._memo = {}
+        try:
+            yield self
+        finally:
+            self._memo = None
+
+    def submit(self, method, *args):
+        """
+        Start a blocking API call on the shared request pool and return its
+        future, so independent calls overlap their network waits.
+        """
+        # carry the caller's context over, so profiling sees the request
+        context = contextvars.copy_context()
+        return transport.get_executor().submit(context.run, method, *args)
 
     def get_company_access_token(self, company_id):
-        company = RipplingCompany.objects.get(company_id=company_id)
-        if company.is_access_token_valid():
-            return company.access_token
-        else:
-            response = self.refresh_token(company.refresh_token)
-            company.access_token = response.get('access_token')
-            company.refresh_token = response.get('refresh_token')
-            company.expires_in = response.get('expires_in')
-            company.scope = response.get('scope')
-            company.save()
-            return company.access_token
+        self.company_id = company_id
+        return access_tokens.get(company_id, self.refresh_token)
 
     def _get_request_headers(self):
         headers = {
@@ -39,17 +75,117 @@ class RipplingIntegration:
             headers['Authorization'] = f'Bearer {self.access_token}'
         return headers
 
-    def _execute_request(self, method, url, headers=None, data=None):
+    def _execute_request(self, method, url, headers=None, data=None, params=None):
 
         if not headers:
             headers = self._get_request_headers()
 
+        memo = self._memo
+        if method != 'GET' or memo is None:
+            return self._send_request(method, url, headers, data, params)
+
+        key = (url, tuple(sorted((params or {}).items())), headers.get('Authorization'))
+        with self._memo_lock:
+            future = memo.get(key)
+            owner = future is None
+            if owner:
+                future = memo[key] = Future()
+        if not owner:
+            return future.result()
         try:
-            response = requests.request(method, url, headers=headers, data=data)
-            return response.json()
+            result = self._send_request(method, url, headers, data, params)
         except Exception as e:
-            logger.error(f'Error executing request')
-            return None
+            future.set_exception(e)
+            raise
+        future.set_result(result)
+        return result
+
+    def _rate_limiter(self, headers):
+        return rate_limiters.get(self.company_id or headers.get('Authorization'))
+
+    def _send_request(self, method, url, headers, data, params):
+        """
+        Send a request within the company's rate limit and return its decoded
+        JSON body.
+
+        A 429 is retried after its Retry-After delay (or an exponential
+        backoff) since Rippling did not process it. RipplingRateLimitError is
+        raised once retries run out, or right away when waiting for a slot, a
+        token or a retry would take the request past
+        RIPPLING_RATE_LIMIT_MAX_WAIT in total, so web requests never stall on
+        it and queued webhook events are retried later. Any other failure,
+        including a non-2xx response, raises RipplingAPIError so that an error
+        body is never stored as data.
+        """
+        limiter = self._rate_limiter(headers)
+        endpoint = metrics.endpoint_label(url)
+        deadline = time.monotonic() + settings.RIPPLING_RATE_LIMIT_MAX_WAIT
+        retry_after = None
+        for attempt in range(settings.RIPPLING_RATE_LIMIT_MAX_RETRIES + 1):
+            with limiter.slot(max(deadline - time.monotonic(), 0)):
+                start = time.perf_counter()
+                try:
+                    response = transport.request(method, url, headers=headers, data=data, params=params)
+                except requests.RequestException as e:
+                    metrics.api_requests.inc(method=method, endpoint=endpoint, status='error')
+                    raise RipplingAPIError(f'{method} {url} failed: {e!r}') from e
+                finally:
+                    duration = time.perf_counter() - start
+                    metrics.api_duration.observe(duration, method=method, endpoint=endpoint)
+                    profiling.record_http(duration)
+
+            metrics.api_requests.inc(method=method, endpoint=endpoint, status=response.status_code)
+            metrics.api_response_bytes.inc(len(response.content), method=method, endpoint=endpoint)
+            transport_retries = transport.retry_count(response)
+            if transport_retries:
+                metrics.api_retries.inc(transport_retries, method=method, endpoint=endpoint, reason='transport')
+
+            retry_after = None
+            if response.status_code == 429:
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                if retry_after is None:
+                    retry_after = settings.RIPPLING_RATE_LIMIT_BACKOFF * (2 ** attempt)
+            limiter.record(response.status_code, retry_after)
+            if response.status_code == 429:
+                if time.monotonic() + retry_after > deadline:
+                    break
+                logger.warning(f'Rate limited by Rippling, retrying in {retry_after:.1f}s')
+                metrics.api_retries.inc(method=method, endpoint=endpoint, reason='rate_limited')
+                continue
+
+            if not 200 <= response.status_code < 300:
+                raise RipplingAPIError(f'{method} {url} returned {response.status_code}', response.status_code)
+            try:
+                return response.json()
+            except ValueError as e:
+                raise RipplingAPIError(f'{method} {url} returned a body that is not JSON', response.status_code) from e
+
+        raise RipplingRateLimitError(f'Rate limited by Rippling on {method} {url}', retry_after=retry_after)
+
+    def _iter_pages(self, url, page_size=None):
+        """
+        Walk a limit/offset paginated collection, yielding records as each page
+        is decoded so that only one page is held in memory at a time. Stops at
+        the first short or empty page, after a page larger than requested, or
+        at a page starting with the same record as the previous one: both mean
+        the endpoint ignored the pagination parameters. A page that fails to
+        load raises RipplingAPIError, so a partial listing is never mistaken
+        for a complete one.
+        """
+        page_size = page_size or settings.RIPPLING_PAGE_SIZE
+        offset = 0
+        first_id = None
+        while True:
+            page = self._execute_request('GET', url, params={'limit': page_size, 'offset': offset})
+            if not isinstance(page, list):
+                raise RipplingAPIError(f'Could not load the page of {url} at offset {offset}')
+            if first_id is not None and page and isinstance(page[0], dict) and page[0].get('id') == first_id:
+                return
+            yield from page
+            if len(page) != page_size:
+                return
+            first_id = page[0].get('id') if isinstance(page[0], dict) else None
+            offset += len(page)
 
     def get_employee(self, employee_id):
         url = f'{self.base_url}/platform/api/employees/{employee_id}'
@@ -59,6 +195,13 @@ class RipplingIntegration:
         url = f'{self.base_url}/platform/api/employees'
         return self._execute_request('GET', url)
 
+    def iter_employees(self, page_size=None):
+        """
+        Yield every employee of the company, one page at a time.
+        """
+        url = f'{self.base_url}/platform/api/employees'
+        return self._iter_pages(url, page_size)
+
     def get_current_user(self):
         url = f'{self.base_url}/platform/api/me'
         return self._execute_request('GET', url)
@@ -127,9 +270,32 @@ class RipplingIntegration:
           }
         ]
         """
-        url = 'https://api.rippling.com/platform/api/groups'
+        url = f'{self.base_url}/platform/api/groups'
         return self._execute_request('GET', url)
 
+    def iter_groups(self, page_size=None):
+        """
+        Yield every group of the company, one page at a time.
+        """
+        url = f'{self.base_url}/platform/api/groups'
+        return self._iter_pages(url, page_size)
+
+    def _store_employee(self, company, employee_id, employee_data):
+        values = employee_values(employee_data)
+        return save_changes(RipplingEmployee, {'company': company, 'employee_id': employee_id}, values)
+
+    def _store_group(self, company, group_id, group_data):
+        if not group_data:
+            # not in a complete listing of the company's groups, so it no
+            # longer exists upstream
+            logger.warning(f'Group {group_id} of company {company.company_id} was not found, skipping')
+            return None, set()
+        values = group_values(group_data)
+        group, changed = save_changes(RipplingGroup, {'company': company, 'group_id': group_id}, values)
+        if 'users' in changed:
+            sync_group_members(group, group.users)
+        return group, changed
+
     # company
     def _webhook_company_updated(self, data):
         """
@@ -140,10 +306,8 @@ class RipplingIntegration:
         company_primary_email = data.get('company_primary_email')
 
         if id and company_id and company_primary_email:
-            company = RipplingCompany.objects.get_or_create(company_id=company_id)[0]
-            if not company.primary_email == company_primary_email:
-                company.primary_email = company_primary_email
-                company.save()
+            companies.invalidate(company_id)
+            companies.resolve(company_id, company_primary_email)
 
     def _webhook_company_deleted(self, data):
         """
@@ -154,12 +318,10 @@ class RipplingIntegration:
         company_primary_email = data.get('company_primary_email')
 
         if id and company_id and company_primary_email:
-            company = RipplingCompany.objects.get_or_create(company_id=company_id)[0]
-            if not company.primary_email == company_primary_email:
-                company.primary_email = company_primary_email
-                company.save()
-
-            company.delete()
+            RipplingCompany.objects.filter(company_id=company_id).delete()
+            companies.invalidate(company_id)
+            group_snapshots.invalidate(company_id)
+            access_tokens.invalidate(company_id)
 
     def _webhook_company_created(self, data):
         """
@@ -170,10 +332,8 @@ class RipplingIntegration:
         company_primary_email = data.get('company_primary_email')
 
         if id and company_id and company_primary_email:
-            company = RipplingCompany.objects.get_or_create(company_id=company_id)[0]
-            if not company.primary_email == company_primary_email:
-                company.primary_email = company_primary_email
-                company.save()
+            companies.invalidate(company_id)
+            companies.resolve(company_id, company_primary_email)
 
     # employee
     def _webhook_employee_created(self, data):
@@ -185,26 +345,13 @@ class RipplingIntegration:
         company_primary_email = data.get('company_primary_email')
 
         if id and company_id and company_primary_email:
-
-            company = RipplingCompany.objects.get_or_create(company_id=company_id)[0]
-            if not company.primary_email == company_primary_email:
-                company.primary_email = company_primary_email
-                company.save()
-
-            employee = RipplingEmployee.objects.get_or_create(
-                company=company,
-                employee_id=id
-            )[0]
+            company = companies.resolve(company_id, company_primary_email)
 
             # get the employee data
             access_token = self.get_company_access_token(company_id)
             self.access_token = access_token
             employee_data = self.get_employee(id)
-            employee.given_name = employee_data.get('firstName')
-            employee.family_name = employee_data.get('lastName')
-            employee.updated_at = employee_data.get('updatedAt')
-            employee.created_at = employee_data.get('createdAt')
-            employee.save(update_fields=['given_name', 'family_name', 'updated_at', 'created_at'])
+            self._store_employee(company, id, employee_data)
 
     def _webhook_employee_deleted(self, data):
         """
@@ -215,16 +362,8 @@ class RipplingIntegration:
         company_primary_email = data.get('company_primary_email')
 
         if id and company_id and company_primary_email:
-            company = RipplingCompany.objects.get_or_create(company_id=company_id)[0]
-            if not company.primary_email == company_primary_email:
-                company.primary_email = company_primary_email
-                company.save()
-
-            employee = RipplingEmployee.objects.get_or_create(
-                company=company,
-                employee_id=id
-            )[0]
-            employee.delete()
+            company = companies.resolve(company_id, company_primary_email)
+            RipplingEmployee.objects.filter(company=company, employee_id=id).delete()
 
     def _webhook_employee_updated(self, data):
         """
@@ -235,25 +374,13 @@ class RipplingIntegration:
         company_primary_email = data.get('company_primary_email')
 
         if id and company_id and company_primary_email:
-            company = RipplingCompany.objects.get_or_create(company_id=company_id)[0]
-            if not company.primary_email == company_primary_email:
-                company.primary_email = company_primary_email
-                company.save()
-
-            employee = RipplingEmployee.objects.get_or_create(
-                company=company,
-                employee_id=id
-            )[0]
+            company = companies.resolve(company_id, company_primary_email)
 
             # get the employee data
             access_token = self.get_company_access_token(company_id)
             self.access_token = access_token
             employee_data = self.get_employee(id)
-            employee.given_name = employee_data.get('firstName')
-            employee.family_name = employee_data.get('lastName')
-            employee.updated_at = employee_data.get('updatedAt')
-            employee.created_at = employee_data.get('createdAt')
-            employee.save(update_fields=['given_name', 'family_name', 'updated_at', 'created_at'])
+            self._store_employee(company, id, employee_data)
 
     # group
     def _webhook_group_updated(self, data):
@@ -265,27 +392,13 @@ class RipplingIntegration:
         company_primary_email = data.get('company_primary_email')
 
         if id and company_id and company_primary_email:
-            company = RipplingCompany.objects.get_or_create(company_id=company_id)[0]
-            if not company.primary_email == company_primary_email:
-                company.primary_email = company_primary_email
-                company.save()
-
-            group_record = RipplingGroup.objects.get_or_create(
-                company=company,
-                group_id=id
-            )[0]
+            company = companies.resolve(company_id, company_primary_email)
 
             # get the group name
             access_token = self.get_company_access_token(company_id)
             self.access_token = access_token
-            group_data = self.get_groups()
-            for group in group_data:
-                if group.get('id') == id:
-                    group_name = group.get('name')
-                    group_record.name = group_name
-                    group_record.users = group.get('users')
-                    group_record.save()
-                    break
+            group = group_snapshots.get(company_id, id, self.iter_groups, fresh_after=self.event_received_at)
+            self._store_group(company, id, group)
 
     def _webhook_group_created(self, data):
         """
@@ -296,26 +409,12 @@ class RipplingIntegration:
         company_primary_email = data.get('company_primary_email')
 
         if id and company_id and company_primary_email:
-            company = RipplingCompany.objects.get_or_create(company_id=company_id)[0]
-            if not company.primary_email == company_primary_email:
-                company.primary_email = company_primary_email
-                company.save()
-
-            group_record = RipplingGroup.objects.get_or_create(
-                company=company,
-                group_id=id
-            )[0]
+            company = companies.resolve(company_id, company_primary_email)
 
             access_token = self.get_company_access_token(company_id)
             self.access_token = access_token
-            group_data = self.get_groups()
-            for group in group_data:
-                if group.get('id') == id:
-                    group_name = group.get('name')
-                    group_record.name = group_name
-                    group_record.users = group.get('users')
-                    group_record.save()
-                    break
+            group = group_snapshots.get(company_id, id, self.iter_groups, fresh_after=self.event_received_at)
+            self._store_group(company, id, group)
 
     def _webhook_group_deleted(self, data):
         """
@@ -326,13 +425,6 @@ class RipplingIntegration:
         company_primary_email = data.get('company_primary_email')
 
         if id and company_id and company_primary_email:
-            company = RipplingCompany.objects.get_or_create(company_id=company_id)[0]
-            if not company.primary_email == company_primary_email:
-                company.primary_email = company_primary_email
-                company.save()
-
-            group = RipplingGroup.objects.get_or_create(
-                company=company,
-                group_id=id
-            )[0]
-            group.delete()
+            company = companies.resolve(company_id, company_primary_email)
+            RipplingGroup.objects.filter(company=company, group_id=id).delete()
+            group_snapshots.invalidate(company_id, id)
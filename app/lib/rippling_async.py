@@ -0,0 +1,77 @@
+import asyncio
+import contextvars
+import functools
+
+from django.conf import settings
+
+from app.lib import transport
+from app.lib.rippling import RipplingIntegration
+from app.lib.transport import RipplingAPIError
+
+
+class AsyncRipplingIntegration:
+    """
+    Asyncio counterpart to RipplingIntegration.
+
+    Requests share the pooled keep-alive transport and rate limits of the
+    blocking client and are awaited off the event loop, so independent calls
+    overlap their network waits. At most `concurrency` requests are in flight
+    per instance, and never more than the RIPPLING_ASYNC_CONCURRENCY threads
+    of the shared request pool.
+    """
+
+    def __init__(self, access_token=None, company_id=None, concurrency=None):
+        self._client = RipplingIntegration()
+        self._client.access_token = access_token
+        self._client.company_id = company_id
+        self.concurrency = concurrency or settings.RIPPLING_ASYNC_CONCURRENCY
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+
+    @property
+    def access_token(self):
+        return self._client.access_token
+
+    @access_token.setter
+    def access_token(self, value):
+        self._client.access_token = value
+
+    async def _call(self, method, *args):
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            # carry the caller's context over, as submit() does
+            context = contextvars.copy_context()
+            return await loop.run_in_executor(transport.get_executor(), functools.partial(context.run, method, *args))
+
+    async def get_employee(self, employee_id):
+        return await self._call(self._client.get_employee, employee_id)
+
+    async def get_employees(self):
+        return await self._call(self._client.get_employees)
+
+    async def get_groups(self):
+        return await self._call(self._client.get_groups)
+
+    async def get_current_user(self):
+        return await self._call(self._client.get_current_user)
+
+    async def get_user_info(self):
+        return await self._call(self._client.get_user_info)
+
+    async def get_current_company(self):
+        return await self._call(self._client.get_current_company)
+
+    async def _get_employee_or_none(self, employee_id):
+        try:
+            return await self.get_employee(employee_id)
+        except RipplingAPIError as e:
+            if e.status_code == 404:
+                return None
+            raise
+
+    async def gather_employees(self, ids):
+        """
+        Fetch many employees concurrently, returning results in the order of
+        `ids`. Employees that no longer exist come back as None, any other
+        failure is raised.
+        """
+        return await asyncio.gather(*[self._get_employee_or_none(employee_id) for employee_id in ids])
@@ -0,0 +1,91 @@
+import contextvars
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# apps whose rows must be read right after they are written, such as the
+# session created by a login, always read from the primary
+PRIMARY_ONLY_APPS = {'auth', 'contenttypes', 'sessions'}
+
+_request = contextvars.ContextVar('replica_request', default=None)
+
+
+class _RequestState:
+
+    def __init__(self):
+        self.replica_reads = False
+        self.wrote = False
+
+
+def replica_reads(view):
+    """
+    Mark a read-only view whose queries may be served by the replica.
+    """
+    view.replica_reads = True
+    return view
+
+
+class ReplicaRouter:
+    """
+    Send reads to the replica while a request allows it, and everything else
+    to the primary.
+
+    Reads go to the primary again once the request has written anything or
+    while a transaction is open on it, so a request always reads its own
+    writes.
+    """
+
+    def db_for_read(self, model, **hints):
+        state = _request.get()
+        if not settings.DATABASE_REPLICA or state is None or not state.replica_reads or state.wrote:
+            return None
+        if model._meta.app_label in PRIMARY_ONLY_APPS or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+        return settings.DATABASE_REPLICA
+
+    def db_for_write(self, model, **hints):
+        state = _request.get()
+        if state is not None:
+            state.wrote = True
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if not settings.DATABASE_REPLICA:
+            return None
+        databases = {DEFAULT_DB_ALIAS, settings.DATABASE_REPLICA}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, **hints):
+        if settings.DATABASE_REPLICA and db == settings.DATABASE_REPLICA:
+            return False
+        return None
+
+
+class ReplicaMiddleware:
+    """
+    Allow replica reads for GET and HEAD requests to the admin and to views
+    marked with replica_reads.
+    """
+
+    def __init__(self, get_response):
+        if not settings.DATABASE_REPLICA:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = _request.set(_RequestState())
+        try:
+            return self.get_response(request)
+        finally:
+            _request.reset(token)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return None
+        match = request.resolver_match
+        if getattr(view_func, 'replica_reads', False) or (match is not None and match.app_name == 'admin'):
+            _request.get().replica_reads = True
+        return None
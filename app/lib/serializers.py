@@ -0,0 +1,95 @@
+from django.db import models
+
+_serializers = {}
+
+
+def _isoformat(value):
+    return value.isoformat() if value is not None else None
+
+
+class CompiledSerializer:
+    """
+    Serializer for one model whose field plan is computed once.
+
+    Foreign keys are read from their `*_id` attribute and many-to-many ids
+    come from prefetched objects when available, so serializing an instance
+    never loads a related row. serialize_queryset() builds the same dicts
+    from a single values() query plus one query per many-to-many field.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.plan = []
+        self.many_to_many = []
+        for field in model._meta.concrete_fields:
+            convert = _isoformat if isinstance(field, models.DateTimeField) else None
+            self.plan.append((field.name, field.attname, convert))
+        for field in model._meta.many_to_many:
+            self.many_to_many.append(field)
+
+    def _fields(self, fields):
+        if fields is None:
+            return self.plan, self.many_to_many
+        return (
+            [step for step in self.plan if step[0] in fields],
+            [field for field in self.many_to_many if field.name in fields],
+        )
+
+    def serialize(self, instance, fields=None):
+        plan, many_to_many = self._fields(fields)
+        data = {}
+        for name, attname, convert in plan:
+            value = getattr(instance, attname)
+            data[name] = convert(value) if convert else value
+        prefetched = getattr(instance, '_prefetched_objects_cache', {})
+        for field in many_to_many:
+            if field.name in prefetched:
+                data[field.name] = [obj.pk for obj in prefetched[field.name]]
+            else:
+                data[field.name] = list(getattr(instance, field.name).values_list('pk', flat=True))
+        return data
+
+    def serialize_queryset(self, queryset, fields=None):
+        """
+        Serialize every row of `queryset` without instantiating models.
+        """
+        plan, many_to_many = self._fields(fields)
+        attnames = [attname for _, attname, _ in plan]
+        if many_to_many and 'id' not in attnames:
+            attnames.append('id')
+        rows = list(queryset.values(*attnames))
+
+        related = {}
+        if many_to_many and rows:
+            pks = [row['id'] for row in rows]
+            for field in many_to_many:
+                through = field.remote_field.through
+                source = field.m2m_field_name()
+                target = field.m2m_reverse_field_name()
+                ids = {pk: [] for pk in pks}
+                pairs = through.objects.using(queryset.db).filter(**{f'{source}__in': pks}).values_list(f'{source}_id', f'{target}_id')
+                for pk, target_pk in pairs:
+                    ids[pk].append(target_pk)
+                related[field.name] = ids
+
+        data = []
+        for row in rows:
+            item = {}
+            for name, attname, convert in plan:
+                value = row[attname]
+                item[name] = convert(value) if convert else value
+            for field in many_to_many:
+                item[field.name] = related[field.name][row['id']]
+            data.append(item)
+        return data
+
+
+def serializer_for(model):
+    serializer = _serializers.get(model)
+    if serializer is None:
+        serializer = _serializers.setdefault(model, CompiledSerializer(model))
+    return serializer
+
+
+def serialize_queryset(queryset, fields=None):
+    return serializer_for(queryset.model).serialize_queryset(queryset, fields)
@@ -0,0 +1,208 @@
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from app.lib.cache import companies, group_snapshots
+from app.lib.changes import VERSION_FIELDS
+from app.lib.mappers import EMPLOYEE_FIELDS, GROUP_FIELDS, employee_values, group_values
+from app.lib.memberships import sync_memberships
+from app.lib.rippling import RipplingIntegration
+from app.lib.transport import RipplingAPIError
+from app.lib.webhooks import EVENT_MAPPING, dispatch_event
+from app.models import RipplingEmployee, RipplingGroup
+
+logger = logging.getLogger(__name__)
+
+def _batched(records, batch_size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _sync_records(model, company, records, key_field, values, fields, batch_size, on_write=None, keys=None):
+    """
+    Write a stream of API records for one company with one bulk upsert and
+    one bulk_update per batch, each batch in its own transaction. New rows
+    are upserted so that a concurrent webhook insert cannot fail the batch.
+    Rows whose stored Rippling version matches the record are skipped.
+    `on_write` is called with the written rows inside each batch transaction.
+    When the records are known to be limited to `keys`, only those stored
+    rows are loaded.
+    """
+    version_field = VERSION_FIELDS[model]
+    stored = model.objects.filter(company=company)
+    if keys is not None:
+        stored = stored.filter(**{f'{key_field}__in': list(keys)})
+    existing = {
+        key: (pk, version)
+        for key, pk, version in stored.values_list(key_field, 'pk', version_field)
+    }
+    seen = set()
+    created = updated = unchanged = 0
+
+    for batch in _batched(records, batch_size):
+        to_create = []
+        to_update = []
+        for record in batch:
+            key = record.get('id')
+            if not key or key in seen:
+                continue
+            seen.add(key)
+            obj = model(company=company, **{key_field: key}, **values(record))
+            if key in existing:
+                obj.pk, version = existing[key]
+                if version is not None and version == getattr(obj, version_field):
+                    unchanged += 1
+                    continue
+                to_update.append(obj)
+            else:
+                to_create.append(obj)
+
+        with transaction.atomic():
+            if to_create:
+                model.objects.bulk_upsert(to_create, ['company', key_field], fields, batch_size=batch_size)
+            if to_update:
+                model.objects.bulk_update(to_update, fields, batch_size=batch_size)
+            if on_write and (to_create or to_update):
+                on_write(to_create + to_update)
+        created += len(to_create)
+        updated += len(to_update)
+
+    return {'created': created, 'updated': updated, 'unchanged': unchanged}
+
+
+def sync_company_directory(company, rippling=None, batch_size=None):
+    """
+    Pull the full employee and group lists for a company and store them with
+    batched upserts. Returns the number of created and updated rows.
+    """
+    batch_size = batch_size or settings.RIPPLING_SYNC_BATCH_SIZE
+    rippling = rippling or RipplingIntegration()
+    rippling.access_token = rippling.get_company_access_token(company.company_id)
+
+    employees = _sync_records(
+        RipplingEmployee, company, rippling.iter_employees(),
+        'employee_id', employee_values, EMPLOYEE_FIELDS, batch_size
+    )
+    groups = _sync_records(
+        RipplingGroup, company, rippling.iter_groups(),
+        'group_id', group_values, GROUP_FIELDS, batch_size,
+        on_write=lambda groups: sync_memberships(company.pk, {group.pk: group.users for group in groups}),
+    )
+    logger.info(f'Synced directory for company {company.company_id}: employees={employees} groups={groups}')
+    return {'employees': employees, 'groups': groups}
+
+
+def _group_webhook_events(events):
+    """
+    Split a batch of webhook payloads into company events, kept in order, and
+    per-company employee and group changes. Only the last event for an
+    employee or group counts, as with queue coalescing.
+    """
+    company_events = []
+    changes = {}
+    for data in events:
+        event_name = data.get('event_name')
+        id = data.get('id')
+        company_id = data.get('company_id')
+        if event_name not in EVENT_MAPPING or not (id and company_id and data.get('company_primary_email')):
+            continue
+        entity, action = event_name.split('.', 1)
+        if entity == 'company':
+            company_events.append((event_name, data))
+            continue
+        company_changes = changes.setdefault(company_id, {
+            'primary_email': None, 'employee': {}, 'group': {},
+        })
+        company_changes['primary_email'] = data.get('company_primary_email')
+        company_changes[entity].pop(id, None)
+        company_changes[entity][id] = action
+    return company_events, changes
+
+
+def sync_webhook_events(events, rippling=None, batch_size=None):
+    """
+    Apply a batch of webhook payloads in bulk.
+
+    Company events are dispatched one by one. For every other company the
+    changed employees are fetched concurrently and groups come from a single
+    snapshot, then all of the company's deletes and upserts are written in
+    one transaction. Returns per-company counts.
+    """
+    batch_size = batch_size or settings.RIPPLING_SYNC_BATCH_SIZE
+    rippling = rippling or RipplingIntegration()
+    received_at = timezone.now()
+    company_events, changes = _group_webhook_events(events)
+
+    for event_name, data in company_events:
+        dispatch_event(event_name, data, rippling=rippling)
+
+    results = {}
+    with rippling.memoize():
+        for company_id, company_changes in changes.items():
+            results[company_id] = _sync_company_events(
+                rippling, company_id, company_changes, received_at, batch_size
+            )
+    return results
+
+
+def _sync_company_events(rippling, company_id, company_changes, received_at, batch_size):
+    company = companies.resolve(company_id, company_changes['primary_email'])
+    employees = company_changes['employee']
+    groups = company_changes['group']
+    deleted_employees = [id for id, action in employees.items() if action == 'deleted']
+    deleted_groups = [id for id, action in groups.items() if action == 'deleted']
+    changed_employees = [id for id, action in employees.items() if action != 'deleted']
+    changed_groups = [id for id, action in groups.items() if action != 'deleted']
+
+    employee_records = []
+    group_records = []
+    if changed_employees or changed_groups:
+        rippling.access_token = rippling.get_company_access_token(company_id)
+        futures = [rippling.submit(rippling.get_employee, id) for id in changed_employees]
+        for id in changed_groups:
+            # the snapshot is fetched once, after the batch was received
+            group = group_snapshots.get(company_id, id, rippling.iter_groups, fresh_after=received_at)
+            if group:
+                group_records.append(group)
+            else:
+                logger.warning(f'Group {id} of company {company_id} was not found')
+        for id, future in zip(changed_employees, futures):
+            try:
+                employee = future.result()
+            except RipplingAPIError as e:
+                if e.status_code != 404:
+                    raise
+                logger.warning(f'Employee {id} of company {company_id} was not found, skipping')
+                continue
+            employee_records.append(employee)
+
+    with transaction.atomic():
+        if deleted_employees:
+            RipplingEmployee.objects.filter(company=company, employee_id__in=deleted_employees).delete()
+        if deleted_groups:
+            RipplingGroup.objects.filter(company=company, group_id__in=deleted_groups).delete()
+        employee_counts = _sync_records(
+            RipplingEmployee, company, employee_records,
+            'employee_id', employee_values, EMPLOYEE_FIELDS, batch_size,
+            keys=changed_employees,
+        )
+        group_counts = _sync_records(
+            RipplingGroup, company, group_records,
+            'group_id', group_values, GROUP_FIELDS, batch_size,
+            on_write=lambda groups: sync_memberships(company.pk, {group.pk: group.users for group in groups}),
+            keys=changed_groups,
+        )
+    for id in deleted_groups:
+        group_snapshots.invalidate(company_id, id)
+
+    employee_counts['deleted'] = len(deleted_employees)
+    group_counts['deleted'] = len(deleted_groups)
+    return {'employees': employee_counts, 'groups': group_counts}
@@ -0,0 +1,44 @@
+from contextlib import contextmanager
+
+from django.db import connection
+
+from app.lib.profiling import profile
+from app.lib.webhooks import dispatch_event
+
+# Most queries a webhook event may run with cold company and token caches and
+# an expired access token, whether or not it runs inside a test transaction
+WEBHOOK_QUERY_BUDGETS = {
+    'employee.created': 6,
+    'employee.updated': 5,
+    'employee.deleted': 3,
+    'company.created': 2,
+    'company.updated': 2,
+    'company.deleted': 8,
+    'group.created': 9,
+    'group.updated': 6,
+    'group.deleted': 5,
+}
+
+
+@contextmanager
+def query_budget(max_queries, label='block'):
+    """
+    Fail with AssertionError when the block runs more than `max_queries`
+    database queries. Opening the connection is not counted, its setup
+    queries run once per connection rather than per request.
+    """
+    connection.ensure_connection()
+    with profile() as current:
+        yield current
+    if current.db_queries > max_queries:
+        raise AssertionError(f'{label} ran {current.db_queries} queries, the budget is {max_queries}')
+
+
+def assert_webhook_query_budget(event_name, data, rippling=None):
+    """
+    Handle a webhook event inline and fail when it runs more queries than
+    WEBHOOK_QUERY_BUDGETS allows for its event type.
+    """
+    with query_budget(WEBHOOK_QUERY_BUDGETS[event_name], event_name) as current:
+        dispatch_event(event_name, data, rippling=rippling)
+    return current
@@ -0,0 +1,115 @@
+import logging
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from app.models import RipplingCompany
+
+logger = logging.getLogger(__name__)
+
+TOKEN_FIELDS = ['access_token', 'refresh_token', 'expires_in', 'expires_at', 'scope']
+
+
+class TokenRefreshError(Exception):
+    pass
+
+
+class AccessTokenCache:
+    """
+    In-process cache of company access tokens with absolute expiry times.
+
+    A refresh is single-flight within a process: threads wait on a
+    per-company lock and re-check the stored token once they hold it, so
+    only the first caller talks to Rippling. Across processes the stored
+    token is replaced only by the refresh that used the current refresh
+    token, and the others adopt it.
+    """
+
+    def __init__(self):
+        self._tokens = {}
+        self._lock = threading.Lock()
+        self._refresh_locks = {}
+
+    def _cached(self, company_id, min_validity):
+        entry = self._tokens.get(company_id)
+        if entry is None:
+            return None
+        token, expires_at = entry
+        if not expires_at or expires_at - timedelta(seconds=min_validity) <= timezone.now():
+            return None
+        return token
+
+    def _refresh_lock(self, company_id):
+        with self._lock:
+            return self._refresh_locks.setdefault(company_id, threading.Lock())
+
+    def set(self, company_id, token, expires_at):
+        self._tokens[company_id] = (token, expires_at)
+
+    def invalidate(self, company_id):
+        self._tokens.pop(company_id, None)
+
+    def clear(self):
+        self._tokens.clear()
+
+    def get(self, company_id, refresh):
+        """
+        Return a valid access token for the company, calling
+        `refresh(refresh_token)` once across the threads of this process when
+        the stored token has expired.
+        """
+        token = self._cached(company_id, settings.RIPPLING_TOKEN_EXPIRY_MARGIN)
+        if token:
+            return token
+        return self.refresh(company_id, refresh, settings.RIPPLING_TOKEN_EXPIRY_MARGIN)
+
+    def refresh(self, company_id, refresh, min_validity=0):
+        """
+        Refresh the company's token unless, once the in-process lock is held,
+        the stored token is still valid for at least `min_validity` seconds.
+
+        The call to Rippling runs outside any transaction, so a slow refresh
+        never holds a database lock. The new token is written only while the
+        stored refresh token is still the one that was used, so when another
+        process refreshed first its token is kept and returned instead.
+        """
+        with self._refresh_lock(company_id):
+            token = self._cached(company_id, min_validity)
+            if token:
+                return token
+
+            company = RipplingCompany.objects.get(company_id=company_id)
+            if not company.is_access_token_valid(margin=min_validity):
+                company = self._refresh_company(company, refresh)
+
+            self.set(company_id, company.access_token, company.expires_at)
+            return company.access_token
+
+    def _refresh_company(self, company, refresh):
+        used_refresh_token = company.refresh_token
+        try:
+            response = refresh(used_refresh_token)
+        except Exception:
+            # another process may have refreshed first and rotated the
+            # refresh token used here
+            current = RipplingCompany.objects.get(pk=company.pk)
+            if current.refresh_token != used_refresh_token and current.is_access_token_valid():
+                return current
+            raise
+        if not response or not response.get('access_token'):
+            raise TokenRefreshError(f'Could not refresh the access token of company {company.company_id}')
+
+        company.set_token(response)
+        stored = RipplingCompany.objects.filter(pk=company.pk, refresh_token=used_refresh_token).update(
+            **{field: getattr(company, field) for field in TOKEN_FIELDS}
+        )
+        if not stored:
+            # another process stored its refresh first, keep that one
+            return RipplingCompany.objects.get(pk=company.pk)
+        logger.info(f'Refreshed the access token of company {company.company_id}')
+        return company
+
+
+access_tokens = AccessTokenCache()
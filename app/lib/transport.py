@@ -0,0 +1,117 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+_lock = threading.Lock()
+_session = None
+_session_pid = None
+_executor = None
+_executor_pid = None
+
+
+class RipplingAPIError(Exception):
+    """
+    A Rippling request failed or returned an unusable response.
+    """
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def _build_session():
+    """
+    Build a keep-alive session whose connection pool is sized from settings.
+
+    Only idempotent GETs are retried; token exchanges and other POSTs are
+    never replayed by the transport.
+    """
+    retry = Retry(
+        total=settings.RIPPLING_HTTP_MAX_RETRIES,
+        connect=settings.RIPPLING_HTTP_MAX_RETRIES,
+        read=settings.RIPPLING_HTTP_MAX_RETRIES,
+        status=settings.RIPPLING_HTTP_MAX_RETRIES,
+        backoff_factor=settings.RIPPLING_HTTP_RETRY_BACKOFF,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset(['GET']),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=settings.RIPPLING_HTTP_POOL_CONNECTIONS,
+        pool_maxsize=settings.RIPPLING_HTTP_POOL_SIZE,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session():
+    """
+    Return the process-wide pooled session, rebuilding it after a fork so
+    that child processes never share sockets with their parent.
+    """
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _lock:
+            if _session is None or _session_pid != pid:
+                _session = _build_session()
+                _session_pid = pid
+    return _session
+
+
+def close_session():
+    global _session, _session_pid
+    with _lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+        _session_pid = None
+
+
+def get_executor():
+    """
+    Return the process-wide thread pool used to overlap blocking Rippling
+    calls, sized by RIPPLING_ASYNC_CONCURRENCY.
+    """
+    global _executor, _executor_pid
+    pid = os.getpid()
+    if _executor is None or _executor_pid != pid:
+        with _lock:
+            if _executor is None or _executor_pid != pid:
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.RIPPLING_ASYNC_CONCURRENCY,
+                    thread_name_prefix='rippling-request',
+                )
+                _executor_pid = pid
+    return _executor
+
+
+def get_timeout():
+    return (settings.RIPPLING_HTTP_CONNECT_TIMEOUT, settings.RIPPLING_HTTP_READ_TIMEOUT)
+
+
+def request(method, url, headers=None, data=None, params=None):
+    return get_session().request(
+        method,
+        url,
+        headers=headers,
+        data=data,
+        params=params,
+        timeout=get_timeout(),
+    )
+
+
+def retry_count(response):
+    """
+    Number of times urllib3 retried the request behind `response`.
+    """
+    retries = getattr(response.raw, 'retries', None)
+    return len(retries.history) if retries is not None else 0
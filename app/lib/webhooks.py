@@ -0,0 +1,277 @@
+import json
+import logging
+import random
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Q
+from django.utils import timezone
+
+from app.lib import metrics
+from app.lib.ratelimit import RipplingRateLimitError
+from app.lib.rippling import RipplingIntegration
+from app.models import RipplingWebhookEvent
+
+logger = logging.getLogger(__name__)
+
+EVENT_MAPPING = {
+    'employee.created': '_webhook_employee_created',
+    'employee.updated': '_webhook_employee_updated',
+    'employee.deleted': '_webhook_employee_deleted',
+    'company.updated': '_webhook_company_updated',
+    'company.deleted': '_webhook_company_deleted',
+    'company.created': '_webhook_company_created',
+    'group.updated': '_webhook_group_updated',
+    'group.created': '_webhook_group_created',
+    'group.deleted': '_webhook_group_deleted',
+}
+
+# Entities whose handlers fetch the latest state from Rippling, so a burst of
+# events for the same object can be folded into a single handler run.
+COALESCED_ENTITIES = ('employee', 'group')
+
+
+def _entity(event_name):
+    return event_name.split('.', 1)[0]
+
+
+def _coalescing_key(event_name, company_id, object_id):
+    entity = _entity(event_name)
+    if entity in COALESCED_ENTITIES and company_id and object_id:
+        return (entity, company_id, object_id)
+    return None
+
+
+def dispatch_event(event_name, data, rippling=None, received_at=None):
+    """
+    Run the RipplingIntegration handler for an event synchronously.
+    """
+    rippling = rippling or RipplingIntegration()
+    rippling.event_received_at = received_at
+    method = getattr(rippling, EVENT_MAPPING[event_name])
+    start = time.perf_counter()
+    outcome = 'error'
+    try:
+        with metrics.count_queries() as queries:
+            method(data)
+        outcome = 'success'
+    except RipplingRateLimitError:
+        outcome = 'rate_limited'
+        raise
+    finally:
+        metrics.webhook_events.inc(event=event_name, outcome=outcome)
+        metrics.webhook_duration.observe(time.perf_counter() - start, event=event_name)
+        metrics.webhook_queries.observe(queries.count, event=event_name)
+
+
+def enqueue_event(event_name, data):
+    """
+    Persist an incoming event so that a worker can process it later.
+
+    Employee and group events are held back for the coalescing window so that
+    a burst of events for the same object is handled once.
+    """
+    available_at = timezone.now()
+    if _coalescing_key(event_name, data.get('company_id'), data.get('id')):
+        available_at += timedelta(seconds=settings.RIPPLING_WEBHOOK_COALESCE_WINDOW)
+    return RipplingWebhookEvent.objects.create(
+        event_name=event_name,
+        company_id=data.get('company_id'),
+        object_id=data.get('id'),
+        payload=data,
+        available_at=available_at,
+    )
+
+
+def enqueue_events(events):
+    """
+    Persist a batch of incoming events with a single bulk insert. Events
+    with an unknown name are dropped. Returns the created rows.
+    """
+    now = timezone.now()
+    held_until = now + timedelta(seconds=settings.RIPPLING_WEBHOOK_COALESCE_WINDOW)
+    rows = []
+    for data in events:
+        event_name = data.get('event_name')
+        if event_name not in EVENT_MAPPING:
+            continue
+        coalesced = _coalescing_key(event_name, data.get('company_id'), data.get('id'))
+        rows.append(RipplingWebhookEvent(
+            event_name=event_name,
+            company_id=data.get('company_id'),
+            object_id=data.get('id'),
+            payload=data,
+            available_at=held_until if coalesced else now,
+        ))
+    return RipplingWebhookEvent.objects.bulk_create(rows, batch_size=settings.RIPPLING_SYNC_BATCH_SIZE)
+
+
+def parse_events(body):
+    """
+    Decode a batch request body, either a JSON array of events or one JSON
+    event per line (NDJSON). Raises ValueError when the body is malformed.
+    """
+    text = body.decode('utf-8') if isinstance(body, bytes) else body
+    stripped = text.strip()
+    if stripped.startswith('['):
+        events = json.loads(stripped)
+    else:
+        events = [json.loads(line) for line in stripped.splitlines() if line.strip()]
+    if not all(isinstance(event, dict) for event in events):
+        raise ValueError('Every event must be a JSON object')
+    return events
+
+
+def _claimable(now):
+    stale = now - timedelta(seconds=settings.RIPPLING_WEBHOOK_LOCK_TIMEOUT)
+    return (
+        Q(status=RipplingWebhookEvent.STATUS_PENDING, available_at__lte=now) |
+        Q(status=RipplingWebhookEvent.STATUS_PROCESSING, locked_at__lt=stale)
+    )
+
+
+def claim_events(limit):
+    """
+    Claim up to `limit` due events for this worker.
+
+    Each row is claimed with a conditional UPDATE, so concurrent workers on
+    any database backend never process the same event twice. Events left in
+    processing by a crashed worker become claimable again after
+    RIPPLING_WEBHOOK_LOCK_TIMEOUT seconds.
+
+    At most one event per coalescing key is claimed at a time, so events for
+    the same employee or group are never handled out of order in parallel.
+    """
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.RIPPLING_WEBHOOK_LOCK_TIMEOUT)
+    busy = set(
+        _coalescing_key(*row) for row in RipplingWebhookEvent.objects.filter(
+            status=RipplingWebhookEvent.STATUS_PROCESSING,
+            locked_at__gte=stale,
+        ).values_list('event_name', 'company_id', 'object_id')
+    )
+    candidates = (
+        RipplingWebhookEvent.objects
+        .filter(_claimable(now))
+        .order_by('available_at', 'id')
+        .values_list('id', 'event_name', 'company_id', 'object_id')[:limit * 4]
+    )
+    claimed = []
+    for pk, event_name, company_id, object_id in candidates:
+        if len(claimed) >= limit:
+            break
+        key = _coalescing_key(event_name, company_id, object_id)
+        if key and key in busy:
+            continue
+        updated = RipplingWebhookEvent.objects.filter(_claimable(now), pk=pk).update(
+            status=RipplingWebhookEvent.STATUS_PROCESSING,
+            locked_at=now,
+        )
+        if updated:
+            claimed.append(pk)
+            if key:
+                busy.add(key)
+    return claimed
+
+
+def coalesce_event(event):
+    """
+    Fold every pending event for the same employee or group into `event`.
+
+    The most recent event wins: its name and payload are copied onto `event`,
+    so a trailing delete is still applied after earlier updates and a
+    re-create after a delete still fetches the current record. Returns the
+    time at which the winning event was received.
+    """
+    key = _coalescing_key(event.event_name, event.company_id, event.object_id)
+    if not key:
+        return event.created_at
+
+    pending = RipplingWebhookEvent.objects.filter(
+        status=RipplingWebhookEvent.STATUS_PENDING,
+        company_id=event.company_id,
+        object_id=event.object_id,
+        event_name__startswith=f'{key[0]}.',
+    )
+    ids = list(pending.values_list('id', flat=True))
+    if not ids:
+        return event.created_at
+
+    pending.filter(pk__in=ids).update(
+        status=RipplingWebhookEvent.STATUS_COALESCED,
+        processed_at=timezone.now(),
+    )
+    folded = list(
+        RipplingWebhookEvent.objects
+        .filter(pk__in=ids, status=RipplingWebhookEvent.STATUS_COALESCED)
+        .order_by('id')
+        .values_list('id', 'event_name', 'payload', 'created_at')
+    )
+    if folded and folded[-1][0] > event.pk:
+        event.event_name = folded[-1][1]
+        event.payload = folded[-1][2]
+        return folded[-1][3]
+    return event.created_at
+
+
+def _retry_delay(attempts):
+    delay = settings.RIPPLING_WEBHOOK_RETRY_BACKOFF * (2 ** (attempts - 1))
+    delay = min(delay, settings.RIPPLING_WEBHOOK_RETRY_MAX_DELAY)
+    return delay + random.uniform(0, delay / 2)
+
+
+def process_event(pk):
+    """
+    Process one claimed event, scheduling a retry with exponential backoff
+    when the handler raises.
+    """
+    close_old_connections()
+    try:
+        event = RipplingWebhookEvent.objects.get(pk=pk)
+        event.attempts += 1
+        received_at = coalesce_event(event)
+        if received_at != event.created_at:
+            event.save(update_fields=['event_name', 'payload'])
+        try:
+            dispatch_event(event.event_name, event.payload, received_at=received_at)
+        except RipplingRateLimitError as e:
+            # throttling is not a failure of the event, retry it once the
+            # limit has passed without using up an attempt
+            logger.warning(f'Webhook event {event.pk} ({event.event_name}) was rate limited, retrying')
+            event.last_error = repr(e)
+            event.locked_at = None
+            event.attempts -= 1
+            event.status = RipplingWebhookEvent.STATUS_PENDING
+            event.available_at = timezone.now() + timedelta(seconds=max(e.retry_after or 0, _retry_delay(1)))
+        except Exception as e:
+            event.last_error = repr(e)
+            event.locked_at = None
+            if event.attempts >= settings.RIPPLING_WEBHOOK_MAX_ATTEMPTS:
+                logger.error(f'Giving up on webhook event {event.pk} ({event.event_name}) after {event.attempts} attempts')
+                event.status = RipplingWebhookEvent.STATUS_FAILED
+            else:
+                logger.warning(f'Webhook event {event.pk} ({event.event_name}) failed, retrying')
+                event.status = RipplingWebhookEvent.STATUS_PENDING
+                event.available_at = timezone.now() + timedelta(seconds=_retry_delay(event.attempts))
+        else:
+            event.status = RipplingWebhookEvent.STATUS_DONE
+            event.processed_at = timezone.now()
+            event.last_error = None
+        event.save(update_fields=['status', 'attempts', 'available_at', 'locked_at', 'processed_at', 'last_error'])
+        return event.status
+    finally:
+        close_old_connections()
+
+
+def purge_processed_events(older_than):
+    """
+    Delete events that finished successfully, or were coalesced into another
+    event, more than `older_than` seconds ago.
+    """
+    cutoff = timezone.now() - timedelta(seconds=older_than)
+    return RipplingWebhookEvent.objects.filter(
+        status__in=[RipplingWebhookEvent.STATUS_DONE, RipplingWebhookEvent.STATUS_COALESCED],
+        processed_at__lt=cutoff,
+    ).delete()[0]
@@ -0,0 +1,162 @@
+import math
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection, connections
+from django.test import Client, override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from app.lib import metrics
+from app.lib.cache import companies, group_snapshots
+from app.lib.fake_rippling import FakeRipplingDirectory, FakeRipplingServer
+from app.lib.idempotency import receipts
+from app.lib.ratelimit import rate_limiters
+from app.lib.tokens import access_tokens
+
+OPERATIONS = ['install', 'sso', 'webhook']
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the install, SSO and webhook views against a local fake Rippling API.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--operations', default=','.join(OPERATIONS), help='Comma separated operations to run, in order.')
+        parser.add_argument('--requests', type=int, default=200, help='Requests per operation.')
+        parser.add_argument('--concurrency', type=int, default=4, help='Concurrent clients.')
+        parser.add_argument('--latency', type=float, default=20, help='Latency of the fake API in milliseconds.')
+        parser.add_argument('--companies', type=int, default=2, help='Companies in the fake directory.')
+        parser.add_argument('--employees', type=int, default=500, help='Employees per company.')
+        parser.add_argument('--groups', type=int, default=20, help='Groups per company.')
+        parser.add_argument('--rate-limit', type=float, default=1000, help='Client rate limit per company, requests per second.')
+        parser.add_argument('--queue', action='store_true', help='Queue webhooks instead of handling them inline.')
+        parser.add_argument('--seed', type=int, default=0, help='Seed for the random choice of employees and groups.')
+
+    def handle(self, *args, **options):
+        operations = [operation.strip() for operation in options['operations'].split(',') if operation.strip()]
+        unknown = set(operations).difference(OPERATIONS)
+        if unknown:
+            self.stderr.write(f'Unknown operations: {", ".join(sorted(unknown))}')
+            return
+
+        self.random = random.Random(options['seed'])
+        self.directory = FakeRipplingDirectory(options['companies'], options['employees'], options['groups'])
+        self.server = FakeRipplingServer(self.directory, latency=options['latency'] / 1000).start()
+
+        # run against a throwaway file database so that concurrent clients
+        # behave as they would in production
+        test_settings = connection.settings_dict.setdefault('TEST', {})
+        tmpdir = None
+        if connection.vendor == 'sqlite' and not test_settings.get('NAME'):
+            tmpdir = tempfile.mkdtemp(prefix='benchmark-rippling-')
+            test_settings['NAME'] = os.path.join(tmpdir, 'benchmark.sqlite3')
+
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            with override_settings(
+                RIPPLING_BASE_URL=self.server.url,
+                RIPPLING_WEBHOOK_QUEUE_ENABLED=options['queue'],
+                RIPPLING_RATE_LIMIT_RATE=options['rate_limit'],
+                RIPPLING_RATE_LIMIT_BURST=int(options['rate_limit']),
+                RIPPLING_WEBHOOK_DELIVERY_ID_HEADER='X-Delivery-Id',
+            ):
+                self._reset_caches()
+                if operations[0] != 'install':
+                    # sso and webhooks need installed companies
+                    self._install_companies()
+                self._report_header()
+                for operation in operations:
+                    self._run(operation, options['requests'], options['concurrency'])
+        finally:
+            connections.close_all()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            self.server.stop()
+            if tmpdir:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def _reset_caches(self):
+        for cache in (access_tokens, companies, group_snapshots, rate_limiters, receipts):
+            cache.clear()
+
+    def _client(self):
+        # a failing view is a 500 in the errors column, not a crashed run
+        return Client(raise_request_exception=False)
+
+    def _install_companies(self):
+        client = self._client()
+        for company_id in self.directory.company_ids:
+            client.get('/integration/install/', {'code': self.directory.code(company_id)})
+
+    def _install(self, index):
+        company_id = self.directory.company_ids[index % len(self.directory.company_ids)]
+        return self._client().get('/integration/install/', {'code': self.directory.code(company_id)})
+
+    def _sso(self, index):
+        company_id = self.random.choice(self.directory.company_ids)
+        employee = self.random.randrange(self.directory.employees)
+        return self._client().post('/integration/sso/', {
+            'code': self.directory.code(company_id, employee),
+            'companyId': company_id,
+        })
+
+    def _webhook(self, index):
+        company_id = self.random.choice(self.directory.company_ids)
+        if index % 4 == 3:
+            event_name, object_id = 'group.updated', self.directory.group_id(company_id, self.random.randrange(self.directory.groups))
+        else:
+            event_name, object_id = 'employee.updated', self.directory.employee_id(company_id, self.random.randrange(self.directory.employees))
+        return self._client().post('/integration/webhook/', {
+            'event_name': event_name,
+            'id': object_id,
+            'company_id': company_id,
+            'company_primary_email': self.directory.company(company_id)['primaryEmail'],
+        }, headers={'X-Delivery-Id': uuid.uuid4().hex})
+
+    def _measure(self, operation, index):
+        start = time.perf_counter()
+        try:
+            with metrics.count_queries() as queries:
+                response = getattr(self, f'_{operation}')(index)
+        finally:
+            # what the request_finished signal does outside of the test client
+            close_old_connections()
+        return time.perf_counter() - start, queries.count, response.status_code
+
+    def _run(self, operation, requests, concurrency):
+        api_requests = self.server.requests
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='benchmark') as executor:
+            results = list(executor.map(lambda index: self._measure(operation, index), range(requests)))
+            # every worker thread owns a connection, the barrier makes each
+            # of them run exactly one close
+            barrier = threading.Barrier(concurrency)
+            list(executor.map(lambda _: (barrier.wait(), connection.close()), range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+        latencies = [latency for latency, _, _ in results]
+        errors = sum(1 for _, _, status in results if status >= 400)
+        self.stdout.write(
+            f'{operation:<10}{requests:>9}{errors:>8}{requests / elapsed:>11.1f}'
+            f'{_percentile(latencies, 0.5) * 1000:>10.1f}{_percentile(latencies, 0.99) * 1000:>10.1f}'
+            f'{sum(count for _, count, _ in results) / requests:>11.1f}'
+            f'{(self.server.requests - api_requests) / requests:>11.1f}'
+        )
+
+    def _report_header(self):
+        self.stdout.write(
+            f'{"operation":<10}{"requests":>9}{"errors":>8}{"ops/s":>11}{"p50 ms":>10}{"p99 ms":>10}'
+            f'{"queries/op":>11}{"api/op":>11}'
+        )
@@ -0,0 +1,57 @@
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from app.lib.webhooks import claim_events, process_event, purge_processed_events
+
+logger = logging.getLogger(__name__)
+
+
+def _init_process_worker():
+    django.setup()
+    connections.close_all()
+
+
+class Command(BaseCommand):
+    help = 'Drain the queue of incoming Rippling webhook events.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.RIPPLING_WEBHOOK_WORKERS, help='Number of concurrent workers.')
+        parser.add_argument('--pool', choices=['thread', 'process'], default=settings.RIPPLING_WEBHOOK_WORKER_POOL, help='Run workers as threads or processes.')
+        parser.add_argument('--batch-size', type=int, default=None, help='Events claimed per poll, defaults to twice the number of workers.')
+        parser.add_argument('--poll-interval', type=float, default=settings.RIPPLING_WEBHOOK_POLL_INTERVAL, help='Seconds to sleep when the queue is empty.')
+        parser.add_argument('--once', action='store_true', help='Exit once the queue is empty.')
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+        batch_size = options['batch_size'] or workers * 2
+
+        if options['pool'] == 'process':
+            # never hand an open connection to forked children
+            connections.close_all()
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_process_worker)
+        else:
+            executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='rippling-webhook')
+
+        processed = 0
+        try:
+            with executor:
+                while True:
+                    claimed = claim_events(batch_size)
+                    if not claimed:
+                        purge_processed_events(settings.RIPPLING_WEBHOOK_RETENTION)
+                        if options['once']:
+                            break
+                        time.sleep(options['poll_interval'])
+                        continue
+                    for status in executor.map(process_event, claimed):
+                        processed += 1
+        except KeyboardInterrupt:
+            logger.info('Webhook worker interrupted, shutting down')
+
+        self.stdout.write(f'Processed {processed} webhook events.')
@@ -0,0 +1,75 @@
+import hashlib
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.db.models import Q
+from django.utils import timezone
+
+from app.lib.rippling import RipplingIntegration
+from app.lib.tokens import access_tokens
+from app.models import RipplingCompany
+
+logger = logging.getLogger(__name__)
+
+
+def _offset(company_id, spread):
+    """
+    A stable per-company offset in [0, spread), so tokens issued at the same
+    moment are refreshed at different times instead of in one burst.
+    """
+    digest = hashlib.sha1(company_id.encode()).hexdigest()
+    return int(digest, 16) % max(int(spread), 1)
+
+
+def due_companies(lead, spread):
+    now = timezone.now()
+    horizon = now + timedelta(seconds=lead + spread)
+    candidates = RipplingCompany.objects.filter(
+        Q(expires_at__isnull=True) | Q(expires_at__lte=horizon),
+        refresh_token__isnull=False,
+    ).order_by('expires_at').values_list('company_id', 'expires_at')
+    return [
+        company_id for company_id, expires_at in candidates
+        if expires_at is None or expires_at - timedelta(seconds=lead + _offset(company_id, spread)) <= now
+    ]
+
+
+class Command(BaseCommand):
+    help = 'Refresh Rippling access tokens shortly before they expire.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lead', type=int, default=settings.RIPPLING_TOKEN_REFRESH_LEAD, help='Seconds before expiry at which a token is refreshed.')
+        parser.add_argument('--spread', type=int, default=settings.RIPPLING_TOKEN_REFRESH_SPREAD, help='Window in seconds over which refreshes are spread.')
+        parser.add_argument('--interval', type=float, default=settings.RIPPLING_TOKEN_REFRESH_INTERVAL, help='Seconds between scheduling passes.')
+        parser.add_argument('--once', action='store_true', help='Run a single scheduling pass and exit.')
+
+    def handle(self, *args, **options):
+        lead = options['lead']
+        spread = options['spread']
+        interval = options['interval']
+        rippling = RipplingIntegration()
+
+        try:
+            while True:
+                close_old_connections()
+                started = time.monotonic()
+                due = due_companies(lead, spread)
+                # pace the refreshes of this pass over the polling interval
+                pause = interval / len(due) if due and not options['once'] else 0
+                for company_id in due:
+                    try:
+                        access_tokens.refresh(company_id, rippling.refresh_token, min_validity=lead + spread)
+                        self.stdout.write(f'Refreshed token for {company_id}')
+                    except Exception as e:
+                        logger.error(f'Could not refresh the token of company {company_id}: {e!r}')
+                    time.sleep(pause)
+
+                if options['once']:
+                    break
+                time.sleep(max(interval - (time.monotonic() - started), 0))
+        except KeyboardInterrupt:
+            logger.info('Token refresh scheduler interrupted, shutting down')
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from app.lib.sync import sync_company_directory
+from app.models import RipplingCompany
+
+
+class Command(BaseCommand):
+    help = 'Pull the full employee and group directory of Rippling companies using batched writes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('company_ids', nargs='*', help='Rippling company ids to sync.')
+        parser.add_argument('--all', action='store_true', help='Sync every installed company.')
+        parser.add_argument('--batch-size', type=int, default=None, help='Rows written per transaction.')
+
+    def handle(self, *args, **options):
+        if options['all']:
+            companies = RipplingCompany.objects.all()
+        elif options['company_ids']:
+            companies = RipplingCompany.objects.filter(company_id__in=options['company_ids'])
+        else:
+            raise CommandError('Provide one or more company ids, or --all.')
+
+        for company in companies:
+            result = sync_company_directory(company, batch_size=options['batch_size'])
+            self.stdout.write(
+                f"{company.company_id}: "
+                f"employees created={result['employees']['created']} updated={result['employees']['updated']} "
+                f"unchanged={result['employees']['unchanged']}, "
+                f"groups created={result['groups']['created']} updated={result['groups']['updated']} "
+                f"unchanged={result['groups']['unchanged']}"
+            )
@@ -0,0 +1,34 @@
+# Generated by Django 5.0.1 on 2026-10-18 09:32
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RipplingWebhookEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_name', models.CharField(help_text='The name of the webhook event.', max_length=255)),
+                ('company_id', models.CharField(default=None, help_text='The id of the company the event belongs to.', max_length=255, null=True)),
+                ('object_id', models.CharField(default=None, help_text='The id of the employee, group or company the event is about.', max_length=255, null=True)),
+                ('payload', models.JSONField(default=dict, help_text='The webhook payload as received.')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('done', 'Done'), ('failed', 'Failed')], default='pending', help_text='The processing status of the event.', max_length=32)),
+                ('attempts', models.PositiveIntegerField(default=0, help_text='The number of times processing was attempted.')),
+                ('available_at', models.DateTimeField(default=django.utils.timezone.now, help_text='The earliest time the event may be processed.')),
+                ('locked_at', models.DateTimeField(default=None, help_text='When a worker claimed the event.', null=True)),
+                ('processed_at', models.DateTimeField(default=None, help_text='When processing finished.', null=True)),
+                ('last_error', models.TextField(default=None, help_text='The error raised by the last failed attempt.', null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'available_at'], name='app_webhook_status_avail_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.0.1 on 2026-10-18 09:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0002_webhook_event_queue'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='ripplingwebhookevent',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('done', 'Done'), ('failed', 'Failed'), ('coalesced', 'Coalesced')], default='pending', help_text='The processing status of the event.', max_length=32),
+        ),
+        migrations.AddIndex(
+            model_name='ripplingwebhookevent',
+            index=models.Index(fields=['company_id', 'object_id', 'status'], name='app_webhook_object_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.1 on 2026-10-18 09:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0003_webhook_event_coalescing'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ripplingcompany',
+            name='expires_at',
+            field=models.DateTimeField(db_index=True, default=None, help_text='When the access token expires.', null=True),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.0.1 on 2026-10-18 09:36
+
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def remove_duplicates(apps, schema_editor):
+    """
+    Merge rows that would violate the new unique constraints, keeping the
+    oldest row of each company, employee and group.
+    """
+    RipplingCompany = apps.get_model('app', 'RipplingCompany')
+    RipplingEmployee = apps.get_model('app', 'RipplingEmployee')
+    RipplingGroup = apps.get_model('app', 'RipplingGroup')
+
+    duplicates = RipplingCompany.objects.values('company_id').annotate(keep=Min('id'), count=Count('id')).filter(count__gt=1)
+    for row in duplicates:
+        others = RipplingCompany.objects.filter(company_id=row['company_id']).exclude(id=row['keep'])
+        RipplingEmployee.objects.filter(company__in=others).update(company_id=row['keep'])
+        RipplingGroup.objects.filter(company__in=others).update(company_id=row['keep'])
+        others.delete()
+
+    for model, field in ((RipplingEmployee, 'employee_id'), (RipplingGroup, 'group_id')):
+        duplicates = model.objects.values('company', field).annotate(keep=Min('id'), count=Count('id')).filter(count__gt=1)
+        for row in duplicates:
+            model.objects.filter(company=row['company'], **{field: row[field]}).exclude(id=row['keep']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0004_company_token_expires_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.0.1 on 2026-10-18 09:36
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_remove_duplicate_lookups'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='ripplingcompany',
+            name='company_id',
+            field=models.CharField(default=None, help_text='The id of the company.', max_length=255, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='ripplingemployee',
+            index=models.Index(fields=['employee_id'], name='app_employee_employee_id_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='ripplingemployee',
+            constraint=models.UniqueConstraint(fields=('company', 'employee_id'), name='app_employee_company_unique'),
+        ),
+        migrations.AddConstraint(
+            model_name='ripplinggroup',
+            constraint=models.UniqueConstraint(fields=('company', 'group_id'), name='app_group_company_unique'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.1 on 2026-10-18 09:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_unique_lookups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ripplinggroup',
+            name='version',
+            field=models.CharField(default=None, help_text='The Rippling version of the group.', max_length=255, null=True),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.0.1 on 2026-10-18 09:39
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0007_group_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RipplingGroupMembership',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('employee_id', models.CharField(help_text='The Rippling id of the employee in the group.', max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('company', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rippling_group_memberships', to='app.ripplingcompany')),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='app.ripplinggroup')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['company', 'employee_id'], name='app_membership_employee_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='ripplinggroupmembership',
+            constraint=models.UniqueConstraint(fields=('group', 'employee_id'), name='app_membership_group_unique'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.0.1 on 2026-10-18 09:41
+
+from django.db import migrations
+
+
+def populate_memberships(apps, schema_editor):
+    """
+    Build membership rows from the users list stored on every group.
+    """
+    RipplingGroup = apps.get_model('app', 'RipplingGroup')
+    RipplingGroupMembership = apps.get_model('app', 'RipplingGroupMembership')
+
+    batch = []
+    for group_id, company_id, users in RipplingGroup.objects.values_list('id', 'company_id', 'users').iterator():
+        for employee_id in set(users or []):
+            batch.append(RipplingGroupMembership(company_id=company_id, group_id=group_id, employee_id=employee_id))
+        if len(batch) >= 1000:
+            RipplingGroupMembership.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    if batch:
+        RipplingGroupMembership.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0008_group_memberships'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_memberships, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.0.1 on 2026-10-18 09:45
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0009_populate_group_memberships'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RipplingWebhookReceipt',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(help_text='SHA-256 of the event identity and payload.', max_length=64, unique=True)),
+                ('received_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now, help_text='When the event was first received.')),
+            ],
+        ),
+    ]
@@ -1,11 +1,47 @@
 import datetime
 from django.contrib.auth import get_user_model
-from django.db import models
+from django.db import connections, models
+from django.utils import timezone
+
+from app.lib.serializers import serializer_for
+
+
+class UpsertQuerySet(models.QuerySet):
+    """
+    Native INSERT ... ON CONFLICT DO UPDATE writes keyed on a unique constraint.
+    """
+
+    def bulk_upsert(self, objs, unique_fields, update_fields, batch_size=None):
+        features = connections[self.db].features
+        if not features.supports_update_conflicts:
+            for obj in objs:
+                lookup = {field: getattr(obj, field) for field in unique_fields}
+                defaults = {field: getattr(obj, field) for field in update_fields}
+                obj.pk = self.update_or_create(defaults=defaults, **lookup)[0].pk
+            return objs
+        return self.bulk_create(
+            objs,
+            batch_size=batch_size,
+            update_conflicts=True,
+            unique_fields=unique_fields if features.supports_update_conflicts_with_target else None,
+            update_fields=update_fields,
+        )
+
+    def upsert(self, defaults=None, **kwargs):
+        """
+        Insert or update the row matching `kwargs` with a single statement.
+        Without `defaults` an existing row is left as it is.
+        """
+        defaults = defaults or {}
+        obj = self.model(**kwargs, **defaults)
+        update_fields = list(defaults) or list(kwargs)
+        return self.bulk_upsert([obj], list(kwargs), update_fields)[0]
 
 
 class BaseModel(models.Model):
 
-    created_at = models.DateTimeField(editable=False, auto_now_add=True)
+    # defaults to the insert time, but keeps the creation time given by Rippling
+    created_at = models.DateTimeField(editable=False, default=timezone.now)
     updated_at = models.DateTimeField(
         editable=False, default=datetime.datetime.now)
     user = models.ForeignKey(
@@ -18,42 +54,40 @@ class BaseModel(models.Model):
         abstract = True
 
     def to_dict(self):
-        fields = self._meta.get_fields()
-        data = {}
-        for field in fields:
-            field_type = field.get_internal_type()
-            try:
-                if field_type == 'ForeignKey':
-                    data[field.name] = getattr(self, field.name).id
-                elif field_type == 'ManyToManyField':
-                    data[field.name] = [obj.id for obj in getattr(self, field.name).all()]
-                elif field_type == 'DateTimeField':
-                    data[field.name] = getattr(self, field.name).isoformat()
-                else:
-                    data[field.name] = getattr(self, field.name)
-            except:
-                data[field.name] = None
-        return data
+        return serializer_for(type(self)).serialize(self)
 
 class RipplingCompany(BaseModel):
 
-    company_id = models.CharField(max_length=255, default=None, null=False, help_text="The id of the company.")
+    company_id = models.CharField(max_length=255, default=None, null=False, unique=True, help_text="The id of the company.")
     company_name = models.CharField(max_length=255, default=None, null=True, help_text="The name of the company.")
     access_token = models.CharField(max_length=255, default=None, null=True, help_text="The access token for the company.")
     refresh_token = models.CharField(max_length=255, default=None, null=True, help_text="The refresh token for the company.")
     expires_in = models.CharField(max_length=255, default=None, null=True, help_text="The expiration for the access token.")
+    expires_at = models.DateTimeField(default=None, null=True, db_index=True, help_text="When the access token expires.")
     scope = models.CharField(max_length=10000, default=None, null=True, help_text="The scope for the access token.")
 
     primary_email = models.CharField(max_length=255, default=None, null=True, help_text="The primary email for the company.")
+
+    objects = UpsertQuerySet.as_manager()
+
     def __str__(self):
         return str(self.company_name)
 
-    def is_access_token_valid(self):
-        # time data '129600' does not match format '%Y-%m-%d %H:%M:%S.%f'
-        if not self.expires_in:
+    def is_access_token_valid(self, margin=0):
+        if not self.access_token or not self.expires_at:
             return False
-        iso_format = datetime.datetime.fromtimestamp(int(self.expires_in)).isoformat()
-        return datetime.datetime.now() > datetime.datetime.strptime(iso_format, '%Y-%m-%dT%H:%M:%S')
+        return timezone.now() + datetime.timedelta(seconds=margin) < self.expires_at
+
+    def set_token(self, token_data):
+        """
+        Store an OAuth token response, turning the relative expires_in into an
+        absolute expiry time.
+        """
+        self.access_token = token_data.get('access_token')
+        self.refresh_token = token_data.get('refresh_token') or self.refresh_token
+        self.expires_in = token_data.get('expires_in')
+        self.scope = token_data.get('scope') or self.scope
+        self.expires_at = timezone.now() + datetime.timedelta(seconds=int(self.expires_in or 0))
 
 
 class RipplingEmployee(BaseModel):
@@ -79,6 +113,16 @@ class RipplingEmployee(BaseModel):
     phone_number = models.CharField(max_length=255, default=None, null=True, help_text="The phone_number of the employee.")
     phone_number_verified = models.BooleanField(default=False, help_text="The phone_number_verified of the employee.")
 
+    objects = UpsertQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['company', 'employee_id'], name='app_employee_company_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['employee_id'], name='app_employee_employee_id_idx'),
+        ]
+
     def __str__(self):
         return str(self.name)
 
@@ -89,6 +133,78 @@ class RipplingGroup(BaseModel):
     group_id = models.CharField(max_length=255, default=None, null=False, help_text="The id of the group.")
     name = models.CharField(max_length=255, default=None, null=True, help_text="The name of the group.")
     users = models.JSONField(default=list, null=True, help_text="The users of the group.")
+    version = models.CharField(max_length=255, default=None, null=True, help_text="The Rippling version of the group.")
+
+    objects = UpsertQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['company', 'group_id'], name='app_group_company_unique'),
+        ]
+
+    def __str__(self):
+        return str(self.name)
+
+class RipplingWebhookEvent(models.Model):
+
+    STATUS_PENDING = 'pending'
+    STATUS_PROCESSING = 'processing'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_COALESCED = 'coalesced'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_PROCESSING, 'Processing'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+        (STATUS_COALESCED, 'Coalesced'),
+    ]
+
+    event_name = models.CharField(max_length=255, help_text="The name of the webhook event.")
+    company_id = models.CharField(max_length=255, default=None, null=True, help_text="The id of the company the event belongs to.")
+    object_id = models.CharField(max_length=255, default=None, null=True, help_text="The id of the employee, group or company the event is about.")
+    payload = models.JSONField(default=dict, help_text="The webhook payload as received.")
+    status = models.CharField(max_length=32, choices=STATUS_CHOICES, default=STATUS_PENDING, help_text="The processing status of the event.")
+    attempts = models.PositiveIntegerField(default=0, help_text="The number of times processing was attempted.")
+    available_at = models.DateTimeField(default=timezone.now, help_text="The earliest time the event may be processed.")
+    locked_at = models.DateTimeField(default=None, null=True, help_text="When a worker claimed the event.")
+    processed_at = models.DateTimeField(default=None, null=True, help_text="When processing finished.")
+    last_error = models.TextField(default=None, null=True, help_text="The error raised by the last failed attempt.")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'available_at'], name='app_webhook_status_avail_idx'),
+            models.Index(fields=['company_id', 'object_id', 'status'], name='app_webhook_object_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.event_name} {self.object_id}'
+
+
+class RipplingGroupMembership(models.Model):
+
+    company = models.ForeignKey('app.RipplingCompany', on_delete=models.CASCADE, related_name='rippling_group_memberships')
+    group = models.ForeignKey('app.RipplingGroup', on_delete=models.CASCADE, related_name='memberships')
+    employee_id = models.CharField(max_length=255, help_text="The Rippling id of the employee in the group.")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['group', 'employee_id'], name='app_membership_group_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['company', 'employee_id'], name='app_membership_employee_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.group_id} {self.employee_id}'
+
+
+class RipplingWebhookReceipt(models.Model):
+
+    key = models.CharField(max_length=64, unique=True, help_text="SHA-256 of the event identity and payload.")
+    received_at = models.DateTimeField(default=timezone.now, db_index=True, help_text="When the event was first received.")
 
     def __str__(self):
-        return str(self.name)
\ No newline at end of file
+        return self.key
@@ -1,3 +1,1426 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from email.utils import format_datetime
+from unittest import mock
+from urllib.parse import urlsplit
 
-# Create your tests here.
+import requests
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from app.lib import metrics, transport, webhooks
+from app.lib.cache import GroupSnapshotCache, companies, group_snapshots
+from app.lib.changes import save_changes
+from app.lib.database import configure_sqlite
+from app.lib.fake_rippling import FakeRipplingDirectory
+from app.lib.idempotency import event_key, purge_receipts, receipts
+from app.lib.mappers import employee_values, group_values
+from app.lib.memberships import group_memberships, sync_group_members, sync_memberships
+from app.lib.ratelimit import (
+    AdaptiveConcurrency, CompanyRateLimiter, RipplingRateLimitError, TokenBucket, parse_retry_after, rate_limiters,
+)
+from app.lib.rippling import RipplingIntegration
+from app.lib.routers import ReplicaMiddleware, ReplicaRouter, _request, _RequestState, replica_reads
+from app.lib.rippling_async import AsyncRipplingIntegration
+from app.lib.serializers import serialize_queryset, serializer_for
+from app.lib.sync import sync_company_directory
+from app.lib.testing import WEBHOOK_QUERY_BUDGETS, assert_webhook_query_budget
+from app.lib.tokens import TokenRefreshError, access_tokens
+from app.lib.transport import RipplingAPIError
+from app.lib.webhooks import EVENT_MAPPING
+from app.management.commands.refresh_rippling_tokens import due_companies
+from app.models import RipplingCompany, RipplingEmployee, RipplingGroup, RipplingWebhookEvent, RipplingWebhookReceipt
+
+BASE_URL = 'https://rippling.test'
+
+
+def _response(status_code, payload):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = json.dumps(payload).encode('utf-8')
+    return response
+
+
+class FakeTransport:
+    """
+    Stand-in for transport.request answering from a FakeRipplingDirectory
+    for its first company. As with FakeRipplingServer, an authorization code
+    `<company>:<index>` is exchanged for a token naming the same employee.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.company_id = directory.company_ids[0]
+        self.requests = []
+
+    def __call__(self, method, url, headers=None, data=None, params=None):
+        self.requests.append((method, url))
+        path = urlsplit(url).path.rstrip('/')
+        if method == 'POST' and path == '/api/o/token':
+            principal = (data or {}).get('code') or f'{self.company_id}:0'
+            return _response(200, {'access_token': f'token:{principal}', 'refresh_token': f'refresh:{principal}', 'expires_in': 3600})
+        if path == '/platform/api/employees':
+            return self._page([self.directory.employee(self.company_id, index) for index in range(self.directory.employees)], params)
+        if path.startswith('/platform/api/employees/'):
+            index = self._employee_index(path.rsplit('/', 1)[1])
+            if index is None:
+                return _response(404, {'detail': 'Not found'})
+            return _response(200, self.directory.employee(self.company_id, index))
+        if path == '/platform/api/groups':
+            return self._page([self.directory.group(self.company_id, index) for index in range(self.directory.groups)], params)
+        index = self._principal(headers)
+        if path == '/platform/api/me':
+            employee = self.directory.employee(self.company_id, index)
+            return _response(200, {'id': employee['id'], 'company': self.company_id, 'workEmail': employee['workEmail']})
+        if path == '/platform/api/userinfo':
+            return _response(200, self.directory.user_info(self.company_id, index))
+        if path == '/platform/api/companies/current':
+            return _response(200, self.directory.company(self.company_id))
+        return _response(404, {'detail': 'Not found'})
+
+    def _page(self, records, params):
+        offset, limit = int(params.get('offset', 0)), int(params.get('limit', len(records)))
+        return _response(200, records[offset:offset + limit])
+
+    def _principal(self, headers):
+        token = (headers or {}).get('Authorization', '').removeprefix('Bearer token:')
+        return int(token.rpartition(':')[2] or 0) if token.startswith(f'{self.company_id}:') else 0
+
+    def _employee_index(self, employee_id):
+        prefix = f'{self.company_id}-e'
+        if employee_id.startswith(prefix) and int(employee_id[len(prefix):]) < self.directory.employees:
+            return int(employee_id[len(prefix):])
+        return None
+
+
+@override_settings(RIPPLING_BASE_URL=BASE_URL)
+class RipplingTestCase(TestCase):
+    """
+    Installed company with one stored employee and group, cold in-process
+    caches and the Rippling API answered by a FakeTransport.
+    """
+
+    def setUp(self):
+        for cache in (access_tokens, companies, group_snapshots, rate_limiters, receipts):
+            cache.clear()
+        self.directory = FakeRipplingDirectory(companies=1, employees=10, groups=4)
+        self.transport = FakeTransport(self.directory)
+        patcher = mock.patch.object(transport, 'request', self.transport)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.company_id = self.directory.company_ids[0]
+        self.company = RipplingCompany.objects.create(
+            company_id=self.company_id,
+            company_name='Company',
+            primary_email=self.directory.company(self.company_id)['primaryEmail'],
+            access_token='token',
+            refresh_token='refresh',
+            expires_at=timezone.now() - timedelta(hours=1),
+        )
+        RipplingEmployee.objects.create(
+            company=self.company,
+            employee_id=self.directory.employee_id(self.company_id, 0),
+            **employee_values(self.directory.employee(self.company_id, 0)),
+        )
+        group = RipplingGroup.objects.create(
+            company=self.company,
+            group_id=self.directory.group_id(self.company_id, 0),
+            **group_values(self.directory.group(self.company_id, 0)),
+        )
+        sync_group_members(group, group.users)
+
+    def event(self, object_id):
+        return {
+            'id': object_id,
+            'company_id': self.company_id,
+            'company_primary_email': self.directory.company(self.company_id)['primaryEmail'],
+        }
+
+
+class WebhookQueryBudgetTests(RipplingTestCase):
+
+    def assertWithinBudget(self, event_name, object_id):
+        assert_webhook_query_budget(event_name, self.event(object_id))
+
+    def test_employee_created(self):
+        self.assertWithinBudget('employee.created', self.directory.employee_id(self.company_id, 1))
+        self.assertTrue(RipplingEmployee.objects.filter(employee_id=self.directory.employee_id(self.company_id, 1)).exists())
+
+    def test_employee_updated(self):
+        RipplingEmployee.objects.update(given_name='Old', updated_at=timezone.now() - timedelta(days=1))
+        self.assertWithinBudget('employee.updated', self.directory.employee_id(self.company_id, 0))
+        self.assertEqual(RipplingEmployee.objects.get().given_name, 'Given0')
+
+    def test_employee_deleted(self):
+        self.assertWithinBudget('employee.deleted', self.directory.employee_id(self.company_id, 0))
+        self.assertFalse(RipplingEmployee.objects.exists())
+
+    def test_company_created(self):
+        self.assertWithinBudget('company.created', self.company_id)
+
+    def test_company_updated(self):
+        RipplingCompany.objects.update(primary_email='old@example.com')
+        self.assertWithinBudget('company.updated', self.company_id)
+        self.assertEqual(RipplingCompany.objects.get().primary_email, self.directory.company(self.company_id)['primaryEmail'])
+
+    def test_company_deleted(self):
+        self.assertWithinBudget('company.deleted', self.company_id)
+        self.assertFalse(RipplingCompany.objects.exists())
+
+    def test_group_created(self):
+        self.assertWithinBudget('group.created', self.directory.group_id(self.company_id, 1))
+        self.assertEqual(RipplingGroup.objects.get(group_id=self.directory.group_id(self.company_id, 1)).memberships.count(), 3)
+
+    def test_group_updated(self):
+        RipplingGroup.objects.update(users=[], version='v0')
+        self.assertWithinBudget('group.updated', self.directory.group_id(self.company_id, 0))
+        self.assertEqual(RipplingGroup.objects.get().memberships.count(), 3)
+
+    def test_group_deleted(self):
+        self.assertWithinBudget('group.deleted', self.directory.group_id(self.company_id, 0))
+        self.assertFalse(RipplingGroup.objects.exists())
+
+    def test_every_event_has_a_budget(self):
+        self.assertEqual(set(WEBHOOK_QUERY_BUDGETS), set(EVENT_MAPPING))
+
+
+@override_settings(RIPPLING_WEBHOOK_COALESCE_WINDOW=0)
+class WebhookQueueTestCase(RipplingTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # the test transaction must survive the worker's connection cleanup
+        patcher = mock.patch.object(webhooks, 'close_old_connections')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def enqueue(self, event_name, object_id):
+        return webhooks.enqueue_event(event_name, self.event(object_id))
+
+
+@override_settings(RIPPLING_WEBHOOK_RETRY_BACKOFF=5, RIPPLING_WEBHOOK_MAX_ATTEMPTS=3)
+class WebhookQueueTests(WebhookQueueTestCase):
+
+    def test_claim_events_claims_each_event_once(self):
+        event = self.enqueue('company.updated', self.company_id)
+        self.assertEqual(webhooks.claim_events(10), [event.pk])
+        self.assertEqual(webhooks.claim_events(10), [])
+        event.refresh_from_db()
+        self.assertEqual(event.status, RipplingWebhookEvent.STATUS_PROCESSING)
+
+    @override_settings(RIPPLING_WEBHOOK_COALESCE_WINDOW=60)
+    def test_employee_events_are_held_for_the_coalescing_window(self):
+        self.enqueue('employee.updated', self.directory.employee_id(self.company_id, 0))
+        self.assertEqual(webhooks.claim_events(10), [])
+
+    def test_claim_events_skips_objects_already_being_processed(self):
+        employee_id = self.directory.employee_id(self.company_id, 0)
+        first = self.enqueue('employee.updated', employee_id)
+        self.enqueue('employee.updated', employee_id)
+        self.assertEqual(webhooks.claim_events(10), [first.pk])
+        self.assertEqual(webhooks.claim_events(10), [])
+
+    def test_stale_claims_are_claimed_again(self):
+        event = self.enqueue('company.updated', self.company_id)
+        RipplingWebhookEvent.objects.filter(pk=event.pk).update(
+            status=RipplingWebhookEvent.STATUS_PROCESSING,
+            locked_at=timezone.now() - timedelta(seconds=settings.RIPPLING_WEBHOOK_LOCK_TIMEOUT + 1),
+        )
+        self.assertEqual(webhooks.claim_events(10), [event.pk])
+
+    def test_successful_event_is_done(self):
+        event = self.enqueue('employee.created', self.directory.employee_id(self.company_id, 1))
+        self.assertEqual(webhooks.process_event(*webhooks.claim_events(1)), RipplingWebhookEvent.STATUS_DONE)
+        event.refresh_from_db()
+        self.assertEqual(event.attempts, 1)
+        self.assertIsNotNone(event.processed_at)
+        self.assertTrue(RipplingEmployee.objects.filter(employee_id=self.directory.employee_id(self.company_id, 1)).exists())
+
+    def test_failed_event_is_retried_with_backoff(self):
+        # unknown to the API, so fetching the employee fails with a 404
+        event = self.enqueue('employee.created', f'{self.company_id}-missing')
+        before = timezone.now()
+        self.assertEqual(webhooks.process_event(*webhooks.claim_events(1)), RipplingWebhookEvent.STATUS_PENDING)
+        event.refresh_from_db()
+        self.assertEqual(event.attempts, 1)
+        self.assertIn('404', event.last_error)
+        self.assertIsNone(event.locked_at)
+        self.assertGreaterEqual(event.available_at, before + timedelta(seconds=5))
+        self.assertLessEqual(event.available_at, timezone.now() + timedelta(seconds=7.5))
+        self.assertEqual(webhooks.claim_events(1), [])
+
+    def test_backoff_doubles_with_every_attempt(self):
+        with mock.patch.object(webhooks.random, 'uniform', return_value=0):
+            self.assertEqual([webhooks._retry_delay(attempts) for attempts in (1, 2, 3)], [5, 10, 20])
+
+    def test_event_fails_after_max_attempts(self):
+        event = self.enqueue('employee.created', f'{self.company_id}-missing')
+        for attempt in range(settings.RIPPLING_WEBHOOK_MAX_ATTEMPTS):
+            RipplingWebhookEvent.objects.filter(pk=event.pk).update(available_at=timezone.now())
+            status = webhooks.process_event(*webhooks.claim_events(1))
+        self.assertEqual(status, RipplingWebhookEvent.STATUS_FAILED)
+        event.refresh_from_db()
+        self.assertEqual(event.attempts, settings.RIPPLING_WEBHOOK_MAX_ATTEMPTS)
+
+    def test_rate_limited_event_keeps_its_attempt(self):
+        event = self.enqueue('company.updated', self.company_id)
+        error = RipplingRateLimitError('Rate limited', retry_after=30)
+        with mock.patch.object(webhooks, 'dispatch_event', side_effect=error):
+            status = webhooks.process_event(*webhooks.claim_events(1))
+        self.assertEqual(status, RipplingWebhookEvent.STATUS_PENDING)
+        event.refresh_from_db()
+        self.assertEqual(event.attempts, 0)
+        self.assertGreaterEqual(event.available_at, timezone.now() + timedelta(seconds=29))
+
+
+@override_settings(RIPPLING_BASE_URL=BASE_URL)
+class AsyncRipplingIntegrationTests(SimpleTestCase):
+
+    def setUp(self):
+        rate_limiters.clear()
+        self.directory = FakeRipplingDirectory(companies=1, employees=10)
+        self.company_id = self.directory.company_ids[0]
+        self.fake = FakeTransport(self.directory)
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        patcher = mock.patch.object(transport, 'request', self.request)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def request(self, *args, **kwargs):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(0.01)
+            return self.fake(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def test_gather_employees_is_bounded_and_ordered(self):
+        ids = [self.directory.employee_id(self.company_id, index) for index in range(8)]
+        client = AsyncRipplingIntegration(access_token='token', company_id=self.company_id, concurrency=2)
+        employees = asyncio.run(client.gather_employees(ids))
+        self.assertEqual([employee['id'] for employee in employees], ids)
+        self.assertEqual(self.max_in_flight, 2)
+
+    def test_missing_employees_are_none(self):
+        client = AsyncRipplingIntegration(access_token='token', company_id=self.company_id)
+        employees = asyncio.run(client.gather_employees([self.directory.employee_id(self.company_id, 0), 'missing']))
+        self.assertEqual(employees[0]['id'], self.directory.employee_id(self.company_id, 0))
+        self.assertIsNone(employees[1])
+
+    def test_other_failures_are_raised(self):
+        self.fake = mock.Mock(return_value=_response(500, {'detail': 'Error'}))
+        client = AsyncRipplingIntegration(access_token='token', company_id=self.company_id)
+        with self.assertRaises(RipplingAPIError):
+            asyncio.run(client.gather_employees([self.directory.employee_id(self.company_id, 0)]))
+
+
+@override_settings(RIPPLING_BASE_URL=BASE_URL)
+class PaginationTests(SimpleTestCase):
+
+    def setUp(self):
+        rate_limiters.clear()
+        self.groups = [{'id': f'g{index}'} for index in range(10)]
+        self.rippling = RipplingIntegration()
+        self.rippling.access_token = 'token'
+
+    def paginate(self, *responses):
+        request = mock.Mock(side_effect=list(responses))
+        with mock.patch.object(transport, 'request', request):
+            groups = list(self.rippling.iter_groups(page_size=4))
+        return groups, request
+
+    def page(self, offset, limit=4):
+        return _response(200, self.groups[offset:offset + limit])
+
+    def test_stops_at_a_short_page(self):
+        groups, request = self.paginate(self.page(0), self.page(4), self.page(8))
+        self.assertEqual(groups, self.groups)
+        self.assertEqual([call.kwargs['params'] for call in request.call_args_list], [
+            {'limit': 4, 'offset': 0}, {'limit': 4, 'offset': 4}, {'limit': 4, 'offset': 8},
+        ])
+
+    def test_stops_at_an_empty_page_after_an_exact_fit(self):
+        groups, request = self.paginate(self.page(0), self.page(4), _response(200, []))
+        self.assertEqual(groups, self.groups[:8])
+        self.assertEqual(request.call_count, 3)
+
+    def test_stops_when_pagination_is_ignored(self):
+        # an endpoint without pagination returns the whole collection every time
+        self.groups = self.groups[:4]
+        groups, request = self.paginate(self.page(0), self.page(0), self.page(0))
+        self.assertEqual(groups, self.groups)
+        self.assertEqual(request.call_count, 2)
+
+    def test_stops_after_a_page_larger_than_requested(self):
+        groups, request = self.paginate(self.page(0, limit=10))
+        self.assertEqual(groups, self.groups)
+
+    def test_a_failed_page_raises(self):
+        with self.assertRaises(RipplingAPIError):
+            self.paginate(self.page(0), _response(500, {'detail': 'Error'}))
+
+    def test_a_page_that_is_not_a_list_raises(self):
+        with self.assertRaises(RipplingAPIError):
+            self.paginate(self.page(0), _response(200, {'detail': 'Error'}))
+
+
+class WebhookCoalescingTests(WebhookQueueTestCase):
+
+    def test_created_updated_deleted_collapses_to_one_delete(self):
+        employee_id = self.directory.employee_id(self.company_id, 1)
+        events = [self.enqueue(name, employee_id) for name in ('employee.created', 'employee.updated', 'employee.deleted')]
+
+        claimed = webhooks.claim_events(10)
+        self.assertEqual(claimed, [events[0].pk])
+        self.assertEqual(webhooks.process_event(claimed[0]), RipplingWebhookEvent.STATUS_DONE)
+
+        statuses = dict(RipplingWebhookEvent.objects.values_list('pk', 'status'))
+        self.assertEqual([statuses[event.pk] for event in events], [
+            RipplingWebhookEvent.STATUS_DONE, RipplingWebhookEvent.STATUS_COALESCED, RipplingWebhookEvent.STATUS_COALESCED,
+        ])
+        self.assertEqual(RipplingWebhookEvent.objects.get(pk=events[0].pk).event_name, 'employee.deleted')
+        self.assertFalse(RipplingEmployee.objects.filter(employee_id=employee_id).exists())
+        self.assertEqual(self.transport.requests, [])
+        self.assertEqual(webhooks.claim_events(10), [])
+
+    def test_recreate_after_delete_fetches_the_employee(self):
+        employee_id = self.directory.employee_id(self.company_id, 0)
+        for name in ('employee.deleted', 'employee.created'):
+            self.enqueue(name, employee_id)
+        webhooks.process_event(*webhooks.claim_events(10))
+        self.assertTrue(RipplingEmployee.objects.filter(employee_id=employee_id).exists())
+        self.assertEqual([url for method, url in self.transport.requests if method == 'GET'], [f'{BASE_URL}/platform/api/employees/{employee_id}'])
+
+    def test_other_objects_are_not_coalesced(self):
+        for index in (0, 1):
+            self.enqueue('employee.updated', self.directory.employee_id(self.company_id, index))
+        self.assertEqual(len(webhooks.claim_events(10)), 2)
+
+
+class AccessTokenCacheTests(TransactionTestCase):
+
+    def setUp(self):
+        access_tokens.clear()
+        self.company = RipplingCompany.objects.create(
+            company_id='company',
+            access_token='expired',
+            refresh_token='refresh',
+            expires_at=timezone.now() - timedelta(hours=1),
+        )
+
+    def token_response(self, name):
+        return {'access_token': f'token:{name}', 'refresh_token': f'refresh:{name}', 'expires_in': 3600}
+
+    def test_concurrent_misses_refresh_once(self):
+        def refresh(refresh_token):
+            time.sleep(0.05)
+            return self.token_response('new')
+        refresh = mock.Mock(side_effect=refresh)
+
+        def get_token():
+            try:
+                return access_tokens.get('company', refresh)
+            finally:
+                connection.close()
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            tokens = list(executor.map(lambda _: get_token(), range(4)))
+
+        self.assertEqual(tokens, ['token:new'] * 4)
+        refresh.assert_called_once_with('refresh')
+        self.company.refresh_from_db()
+        self.assertEqual((self.company.access_token, self.company.refresh_token), ('token:new', 'refresh:new'))
+
+    def test_refresh_runs_outside_a_transaction(self):
+        def refresh(refresh_token):
+            self.assertFalse(connection.in_atomic_block)
+            return self.token_response('new')
+        self.assertEqual(access_tokens.get('company', refresh), 'token:new')
+
+    def test_token_stored_by_another_process_is_reused(self):
+        RipplingCompany.objects.filter(pk=self.company.pk).update(access_token='stored', expires_at=timezone.now() + timedelta(hours=1))
+        refresh = mock.Mock()
+        self.assertEqual(access_tokens.get('company', refresh), 'stored')
+        refresh.assert_not_called()
+
+    def test_refresh_stored_first_by_another_process_wins(self):
+        def refresh(refresh_token):
+            # another process completes its refresh while this one is in flight
+            RipplingCompany.objects.filter(pk=self.company.pk).update(**{
+                'access_token': 'token:other', 'refresh_token': 'refresh:other', 'expires_at': timezone.now() + timedelta(hours=1),
+            })
+            return self.token_response('late')
+        self.assertEqual(access_tokens.get('company', refresh), 'token:other')
+        self.company.refresh_from_db()
+        self.assertEqual(self.company.refresh_token, 'refresh:other')
+
+    def test_failed_refresh_adopts_a_token_rotated_elsewhere(self):
+        def refresh(refresh_token):
+            RipplingCompany.objects.filter(pk=self.company.pk).update(**{
+                'access_token': 'token:other', 'refresh_token': 'refresh:other', 'expires_at': timezone.now() + timedelta(hours=1),
+            })
+            raise RipplingAPIError('invalid_grant', 400)
+        self.assertEqual(access_tokens.get('company', refresh), 'token:other')
+
+    def test_failed_refresh_raises(self):
+        with self.assertRaises(RipplingAPIError):
+            access_tokens.get('company', mock.Mock(side_effect=RipplingAPIError('invalid_grant', 400)))
+        with self.assertRaises(TokenRefreshError):
+            access_tokens.get('company', mock.Mock(return_value={'error': 'invalid_grant'}))
+
+
+class UpsertTests(RipplingTestCase):
+
+    def test_upsert_inserts_a_missing_row(self):
+        employee = RipplingEmployee.objects.upsert(company=self.company, employee_id='new', defaults={'given_name': 'New'})
+        self.assertIsNotNone(employee.pk)
+        self.assertEqual(RipplingEmployee.objects.get(employee_id='new').given_name, 'New')
+
+    def test_upsert_updates_only_the_defaults(self):
+        employee_id = self.directory.employee_id(self.company_id, 0)
+        with CaptureQueriesContext(connection) as queries:
+            employee = RipplingEmployee.objects.upsert(company=self.company, employee_id=employee_id, defaults={'given_name': 'Changed'})
+        self.assertEqual(len(queries), 1)
+        stored = RipplingEmployee.objects.get(employee_id=employee_id)
+        self.assertEqual(stored.pk, employee.pk)
+        self.assertEqual(stored.given_name, 'Changed')
+        self.assertEqual(stored.family_name, 'Family0')
+
+    def test_upsert_without_defaults_keeps_the_row(self):
+        employee_id = self.directory.employee_id(self.company_id, 0)
+        RipplingEmployee.objects.upsert(company=self.company, employee_id=employee_id)
+        self.assertEqual(RipplingEmployee.objects.get(employee_id=employee_id).given_name, 'Given0')
+
+    def test_bulk_upsert_inserts_and_updates(self):
+        rows = [
+            RipplingGroup(company=self.company, group_id=self.directory.group_id(self.company_id, 0), name='Renamed'),
+            RipplingGroup(company=self.company, group_id='new', name='New'),
+        ]
+        RipplingGroup.objects.bulk_upsert(rows, ['company', 'group_id'], ['name'])
+        self.assertEqual(dict(RipplingGroup.objects.values_list('group_id', 'name')), {
+            self.directory.group_id(self.company_id, 0): 'Renamed',
+            'new': 'New',
+        })
+
+
+class RemoveDuplicateLookupsMigrationTests(TransactionTestCase):
+
+    migrate_from = [('app', '0004_company_token_expires_at')]
+    migrate_to = [('app', '0005_remove_duplicate_lookups')]
+
+    def setUp(self):
+        self.executor = MigrationExecutor(connection)
+        self.executor.migrate(self.migrate_from)
+        self.apps = self.executor.loader.project_state(self.migrate_from).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_duplicates_are_merged_into_the_oldest_row(self):
+        Company = self.apps.get_model('app', 'RipplingCompany')
+        Employee = self.apps.get_model('app', 'RipplingEmployee')
+        Group = self.apps.get_model('app', 'RipplingGroup')
+        kept = Company.objects.create(company_id='c1')
+        duplicate = Company.objects.create(company_id='c1')
+        Employee.objects.create(company=kept, employee_id='e1', name='first')
+        Employee.objects.create(company=kept, employee_id='e1', name='second')
+        Employee.objects.create(company=duplicate, employee_id='e2')
+        Group.objects.create(company=duplicate, group_id='g1')
+
+        self.executor = MigrationExecutor(connection)
+        self.executor.migrate(self.migrate_to)
+        apps = self.executor.loader.project_state(self.migrate_to).apps
+        Company = apps.get_model('app', 'RipplingCompany')
+        Employee = apps.get_model('app', 'RipplingEmployee')
+        Group = apps.get_model('app', 'RipplingGroup')
+
+        self.assertEqual(list(Company.objects.values_list('pk', flat=True)), [kept.pk])
+        self.assertEqual(sorted(Employee.objects.values_list('employee_id', 'company_id')), [('e1', kept.pk), ('e2', kept.pk)])
+        self.assertEqual(Employee.objects.get(employee_id='e1').name, 'first')
+        self.assertEqual(Group.objects.get().company_id, kept.pk)
+
+
+class SsoTests(RipplingTestCase):
+
+    def login(self, index):
+        return self.client.post('/integration/sso/', {'code': self.directory.code(self.company_id, index), 'companyId': self.company_id})
+
+    def test_first_login_creates_the_employee_and_user(self):
+        response = self.login(1)
+        self.assertEqual(response.status_code, 302)
+        employee = RipplingEmployee.objects.get(employee_id=self.directory.employee_id(self.company_id, 1))
+        self.assertEqual(employee.given_name, 'Given1')
+        self.assertEqual(employee.user.username, f'{employee.employee_id}:{self.company_id}')
+
+    def test_concurrent_first_login_reuses_the_employee(self):
+        employee_id = self.directory.employee_id(self.company_id, 1)
+        reread = RipplingEmployee.objects.select_related('company', 'user')
+
+        class LostRace:
+            # another login inserts the employee right after this one looked for it
+            def get(self, **lookup):
+                RipplingEmployee.objects.create(company=RipplingCompany.objects.get(), employee_id=employee_id)
+                raise RipplingEmployee.DoesNotExist
+
+        with mock.patch.object(RipplingEmployee.objects, 'select_related', side_effect=[LostRace(), reread]):
+            response = self.login(1)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(RipplingEmployee.objects.filter(employee_id=employee_id).count(), 1)
+        self.assertEqual(RipplingEmployee.objects.get(employee_id=employee_id).given_name, 'Given1')
+
+    def test_login_sends_each_api_request_once(self):
+        self.login(1)
+        self.assertEqual(sorted(urlsplit(url).path for method, url in self.transport.requests), [
+            '/api/o/token/',
+            '/platform/api/employees/' + self.directory.employee_id(self.company_id, 1),
+            '/platform/api/me',
+        ])
+
+
+class SaveChangesTests(RipplingTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.employee_id = self.directory.employee_id(self.company_id, 0)
+        self.lookup = {'company': self.company, 'employee_id': self.employee_id}
+        self.values = employee_values(self.directory.employee(self.company_id, 0))
+
+    def test_same_version_is_skipped(self):
+        with CaptureQueriesContext(connection) as queries:
+            employee, changed = save_changes(RipplingEmployee, self.lookup, {**self.values, 'given_name': 'Ignored'})
+        self.assertEqual(changed, [])
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(RipplingEmployee.objects.get().given_name, 'Given0')
+
+    def test_unchanged_values_are_skipped(self):
+        del self.values['updated_at']
+        with CaptureQueriesContext(connection) as queries:
+            employee, changed = save_changes(RipplingEmployee, self.lookup, self.values)
+        self.assertEqual(changed, [])
+        self.assertEqual(len(queries), 1)
+
+    def test_only_changed_fields_are_written(self):
+        self.values.update(given_name='Changed', updated_at=self.values['updated_at'] + timedelta(days=1))
+        with CaptureQueriesContext(connection) as queries:
+            employee, changed = save_changes(RipplingEmployee, self.lookup, self.values)
+        self.assertEqual(sorted(changed), ['given_name', 'updated_at'])
+        self.assertEqual(employee.given_name, 'Changed')
+        update = queries.captured_queries[-1]['sql']
+        self.assertIn('given_name', update)
+        self.assertNotIn('family_name', update)
+        self.assertEqual(RipplingEmployee.objects.get().given_name, 'Changed')
+
+    def test_missing_row_is_inserted(self):
+        employee, changed = save_changes(RipplingEmployee, {'company': self.company, 'employee_id': 'new'}, self.values)
+        self.assertEqual(sorted(changed), sorted(self.values))
+        stored = RipplingEmployee.objects.get(employee_id='new')
+        self.assertEqual(stored.family_name, 'Family0')
+        self.assertEqual(stored.created_at, self.values['created_at'])
+
+    def test_rippling_creation_time_is_kept(self):
+        RipplingEmployee.objects.update(created_at=timezone.now(), updated_at=timezone.now())
+        employee, changed = save_changes(RipplingEmployee, self.lookup, self.values)
+        self.assertEqual(sorted(changed), ['created_at', 'updated_at'])
+        self.assertEqual(RipplingEmployee.objects.get().created_at.isoformat(), '2023-01-01T00:00:00+00:00')
+
+    def test_created_webhook_stores_the_rippling_creation_time(self):
+        employee_id = self.directory.employee_id(self.company_id, 1)
+        webhooks.dispatch_event('employee.created', self.event(employee_id))
+        self.assertEqual(RipplingEmployee.objects.get(employee_id=employee_id).created_at.isoformat(), '2023-01-01T00:00:00+00:00')
+
+
+class SerializerTests(RipplingTestCase):
+
+    def test_to_dict_matches_serialize_queryset(self):
+        for model in (RipplingCompany, RipplingEmployee, RipplingGroup):
+            instance = model.objects.get()
+            self.assertEqual(serialize_queryset(model.objects.all()), [instance.to_dict()], model.__name__)
+
+    def test_to_dict_reads_no_related_rows(self):
+        employee = RipplingEmployee.objects.get()
+        with self.assertNumQueries(0):
+            data = employee.to_dict()
+        self.assertEqual(data['company'], self.company.pk)
+        self.assertEqual(data['created_at'], employee.created_at.isoformat())
+        self.assertIsNone(data['user'])
+
+    def test_fields_limit_the_output(self):
+        fields = ['id', 'group_id', 'users']
+        group = RipplingGroup.objects.get()
+        self.assertEqual(serialize_queryset(RipplingGroup.objects.all(), fields), [serializer_for(RipplingGroup).serialize(group, fields)])
+        self.assertEqual(list(serialize_queryset(RipplingGroup.objects.all(), fields)[0]), fields)
+
+    def test_serialize_queryset_runs_one_query(self):
+        RipplingEmployee.objects.create(company=self.company, employee_id='second')
+        with self.assertNumQueries(1):
+            rows = serialize_queryset(RipplingEmployee.objects.order_by('pk'))
+        self.assertEqual([row['employee_id'] for row in rows], [self.directory.employee_id(self.company_id, 0), 'second'])
+
+
+class SyncMembershipsTests(RipplingTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.group = RipplingGroup.objects.get()
+        self.members = self.directory.group(self.company_id, 0)['users']
+
+    def member_ids(self):
+        return set(group_memberships(self.group).values_list('employee_id', flat=True))
+
+    def test_members_are_added_and_removed(self):
+        users = self.members[1:] + ['new']
+        self.assertEqual(sync_memberships(self.company.pk, {self.group.pk: users}), (1, 1))
+        self.assertEqual(self.member_ids(), set(users))
+
+    def test_unchanged_members_write_nothing(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(sync_memberships(self.company.pk, {self.group.pk: self.members}), (0, 0))
+        self.assertEqual(len(queries), 1)
+
+    def test_empty_user_list_removes_every_member(self):
+        self.assertEqual(sync_memberships(self.company.pk, {self.group.pk: None}), (0, len(self.members)))
+        self.assertEqual(self.member_ids(), set())
+
+
+class DirectoryApiTests(RipplingTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for index in range(1, 5):
+            RipplingEmployee.objects.create(company=self.company, employee_id=self.directory.employee_id(self.company_id, index))
+        self.user = get_user_model().objects.create_user(username='member')
+        RipplingEmployee.objects.filter(employee_id=self.directory.employee_id(self.company_id, 0)).update(user=self.user)
+        self.client.force_login(self.user)
+        self.url = f'/integration/api/companies/{self.company_id}/employees/'
+
+    def test_pages_follow_the_cursor(self):
+        seen = []
+        cursor = None
+        while True:
+            params = {'limit': 2, **({'cursor': cursor} if cursor else {})}
+            response = self.client.get(self.url, params)
+            self.assertEqual(response.status_code, 200)
+            body = response.json()
+            self.assertLessEqual(len(body['results']), 2)
+            seen.extend(row['employee_id'] for row in body['results'])
+            cursor = body['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(seen, list(RipplingEmployee.objects.order_by('pk').values_list('employee_id', flat=True)))
+
+    def test_last_full_page_has_no_cursor(self):
+        response = self.client.get(self.url, {'limit': 5})
+        self.assertEqual(len(response.json()['results']), 5)
+        self.assertIsNone(response.json()['next_cursor'])
+
+    def test_bad_cursor_or_limit_is_rejected(self):
+        self.assertEqual(self.client.get(self.url, {'cursor': 'abc'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'limit': 0}).status_code, 400)
+
+    def test_group_members_include_employee_details(self):
+        group_id = self.directory.group_id(self.company_id, 0)
+        response = self.client.get(f'/integration/api/companies/{self.company_id}/groups/{group_id}/members/')
+        results = {row['employee_id']: row for row in response.json()['results']}
+        self.assertEqual(set(results), set(self.directory.group(self.company_id, 0)['users']))
+        self.assertEqual(results[self.directory.employee_id(self.company_id, 0)]['given_name'], 'Given0')
+
+    def test_employee_groups(self):
+        employee_id = self.directory.employee_id(self.company_id, 0)
+        response = self.client.get(f'/integration/api/companies/{self.company_id}/employees/{employee_id}/groups/')
+        self.assertEqual([row['group_id'] for row in response.json()['results']], [self.directory.group_id(self.company_id, 0)])
+
+    def test_anonymous_users_are_redirected_to_login(self):
+        self.client.logout()
+        self.assertEqual(self.client.get(self.url).status_code, 302)
+
+    def test_other_companies_are_hidden(self):
+        other = get_user_model().objects.create_user(username='outsider')
+        self.client.force_login(other)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+        self.assertEqual(self.client.get('/integration/api/companies/unknown/employees/').status_code, 404)
+
+    def test_staff_can_read_any_company(self):
+        staff = get_user_model().objects.create_user(username='staff', is_staff=True)
+        self.client.force_login(staff)
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+
+
+@override_settings(RIPPLING_BASE_URL=BASE_URL)
+class MemoizeTests(SimpleTestCase):
+
+    def setUp(self):
+        rate_limiters.clear()
+        self.directory = FakeRipplingDirectory(companies=1, employees=10)
+        self.transport = FakeTransport(self.directory)
+        patcher = mock.patch.object(transport, 'request', self.transport)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.rippling = RipplingIntegration()
+        self.rippling.access_token = 'token'
+
+    def test_identical_gets_are_sent_once_within_the_block(self):
+        with self.rippling.memoize():
+            first = self.rippling.get_current_user()
+            second = self.rippling.get_current_user()
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.transport.requests), 1)
+
+    def test_concurrent_identical_gets_share_one_request(self):
+        with self.rippling.memoize():
+            futures = [self.rippling.submit(self.rippling.get_current_company) for _ in range(4)]
+            results = [future.result() for future in futures]
+        self.assertEqual(len({json.dumps(result) for result in results}), 1)
+        self.assertEqual(len(self.transport.requests), 1)
+
+    def test_different_credentials_are_not_shared(self):
+        with self.rippling.memoize():
+            self.rippling.get_current_user()
+            self.rippling.access_token = 'other'
+            self.rippling.get_current_user()
+        self.assertEqual(len(self.transport.requests), 2)
+
+    def test_nothing_is_memoized_outside_the_block(self):
+        with self.rippling.memoize():
+            self.rippling.get_current_user()
+        self.rippling.get_current_user()
+        self.assertEqual(len(self.transport.requests), 2)
+
+    def test_failures_are_not_memoized_across_blocks(self):
+        self.transport = mock.Mock(side_effect=[_response(500, {}), _response(200, {'id': 'user'})])
+        with mock.patch.object(transport, 'request', self.transport):
+            with self.rippling.memoize():
+                with self.assertRaises(RipplingAPIError):
+                    self.rippling.get_current_user()
+            with self.rippling.memoize():
+                self.assertEqual(self.rippling.get_current_user(), {'id': 'user'})
+
+
+class RateLimitTests(SimpleTestCase):
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after('5'), 5)
+        self.assertEqual(parse_retry_after('-3'), 0)
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after('soon'))
+        in_a_minute = format_datetime(timezone.now() + timedelta(seconds=60), usegmt=True)
+        self.assertAlmostEqual(parse_retry_after(in_a_minute), 60, delta=2)
+
+    def test_bucket_allows_a_burst_then_waits(self):
+        bucket = TokenBucket(rate=20, capacity=2)
+        start = time.monotonic()
+        for _ in range(3):
+            bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
+
+    def test_bucket_raises_instead_of_waiting_past_max_wait(self):
+        bucket = TokenBucket(rate=1, capacity=1)
+        bucket.acquire()
+        with self.assertRaises(RipplingRateLimitError) as raised:
+            bucket.acquire(max_wait=0.1)
+        self.assertAlmostEqual(raised.exception.retry_after, 1, delta=0.1)
+
+    def test_pause_holds_every_caller(self):
+        bucket = TokenBucket(rate=100, capacity=10)
+        bucket.pause(5)
+        with self.assertRaises(RipplingRateLimitError) as raised:
+            bucket.acquire(max_wait=1)
+        self.assertAlmostEqual(raised.exception.retry_after, 5, delta=0.1)
+
+    def test_concurrency_halves_on_backoff_and_grows_slowly(self):
+        concurrency = AdaptiveConcurrency(initial=4, minimum=1, maximum=4)
+        concurrency.backoff()
+        self.assertEqual(concurrency.limit, 2)
+        concurrency.backoff()
+        concurrency.backoff()
+        self.assertEqual(concurrency.limit, 1)
+        concurrency.success()
+        self.assertEqual(concurrency.limit, 2)
+        concurrency.success()
+        self.assertEqual(concurrency.limit, 2.5)
+        for _ in range(10):
+            concurrency.success()
+        self.assertEqual(concurrency.limit, 4)
+
+    def test_concurrency_acquire_times_out(self):
+        concurrency = AdaptiveConcurrency(initial=1, minimum=1, maximum=1)
+        self.assertTrue(concurrency.acquire())
+        start = time.monotonic()
+        self.assertFalse(concurrency.acquire(timeout=0.05))
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+        concurrency.release()
+        self.assertTrue(concurrency.acquire(timeout=0))
+
+    @override_settings(RIPPLING_RATE_LIMIT_RATE=100, RIPPLING_RATE_LIMIT_BURST=100, RIPPLING_RATE_LIMIT_MAX_CONCURRENCY=1)
+    def test_slot_raises_when_no_slot_frees_up(self):
+        limiter = CompanyRateLimiter()
+        with limiter.slot():
+            with self.assertRaises(RipplingRateLimitError):
+                with limiter.slot(max_wait=0.05):
+                    pass
+        with limiter.slot(max_wait=0):
+            pass
+
+    @override_settings(RIPPLING_RATE_LIMIT_RATE=100, RIPPLING_RATE_LIMIT_BURST=100, RIPPLING_RATE_LIMIT_MAX_CONCURRENCY=4)
+    def test_record_backs_off_on_throttling_and_errors(self):
+        limiter = CompanyRateLimiter()
+        limiter.record(429, retry_after=5)
+        self.assertEqual(limiter.concurrency.limit, 2)
+        self.assertGreater(limiter.bucket.paused_until, time.monotonic() + 4)
+        limiter.record(503)
+        self.assertEqual(limiter.concurrency.limit, 1)
+        limiter.record(200)
+        self.assertEqual(limiter.concurrency.limit, 2)
+
+
+@override_settings(
+    RIPPLING_BASE_URL=BASE_URL,
+    RIPPLING_RATE_LIMIT_MAX_WAIT=1,
+    RIPPLING_RATE_LIMIT_MAX_RETRIES=3,
+    RIPPLING_RATE_LIMIT_BACKOFF=0.01,
+)
+class RateLimitedRequestTests(SimpleTestCase):
+
+    def setUp(self):
+        rate_limiters.clear()
+        self.rippling = RipplingIntegration()
+        self.rippling.access_token = 'token'
+
+    def send(self, *responses):
+        request = mock.Mock(side_effect=list(responses))
+        with mock.patch.object(transport, 'request', request):
+            try:
+                return self.rippling.get_current_user()
+            finally:
+                self.calls = request.call_count
+
+    def throttled(self, retry_after=None):
+        response = _response(429, {'detail': 'Throttled'})
+        if retry_after is not None:
+            response.headers['Retry-After'] = str(retry_after)
+        return response
+
+    def test_throttled_request_is_retried(self):
+        self.assertEqual(self.send(self.throttled(0.01), self.throttled(), _response(200, {'id': 'user'})), {'id': 'user'})
+        self.assertEqual(self.calls, 3)
+
+    def test_long_retry_after_raises_right_away(self):
+        with self.assertRaises(RipplingRateLimitError) as raised:
+            self.send(self.throttled(100))
+        self.assertEqual(raised.exception.retry_after, 100)
+        self.assertEqual(self.calls, 1)
+        # the pause applies to the next request of the company too
+        with self.assertRaises(RipplingRateLimitError):
+            self.send(_response(200, {}))
+        self.assertEqual(self.calls, 0)
+
+    def test_retries_running_out_raise(self):
+        with self.assertRaises(RipplingRateLimitError):
+            self.send(*[self.throttled(0.01)] * 4)
+        self.assertEqual(self.calls, 4)
+
+
+class WebhookBatchTests(RipplingTestCase):
+
+    url = '/integration/webhook/batch/'
+
+    def post(self, body, content_type='application/json'):
+        return self.client.post(self.url, body, content_type=content_type)
+
+    def events(self, count):
+        return [
+            {'event_name': 'employee.updated', **self.event(self.directory.employee_id(self.company_id, index))}
+            for index in range(count)
+        ]
+
+    def test_json_array_is_queued(self):
+        response = self.post(json.dumps(self.events(3) + [{'event_name': 'unknown'}]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['events'], 3)
+        self.assertEqual(RipplingWebhookEvent.objects.count(), 3)
+
+    def test_ndjson_is_queued(self):
+        response = self.post('\n'.join(json.dumps(event) for event in self.events(2)) + '\n', 'application/x-ndjson')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(RipplingWebhookEvent.objects.count(), 2)
+
+    def test_get_is_not_allowed(self):
+        self.assertEqual(self.client.get(self.url).status_code, 405)
+
+    def test_malformed_bodies_are_rejected(self):
+        for body in ('[{"event_name": ', '{"event_name": "employee.updated"}\nnot json', '[1, 2]'):
+            response = self.post(body)
+            self.assertEqual(response.status_code, 400, body)
+            self.assertIn('error', response.json())
+        self.assertEqual(RipplingWebhookEvent.objects.count(), 0)
+
+    @override_settings(RIPPLING_WEBHOOK_BATCH_MAX_EVENTS=2)
+    def test_too_many_events_are_rejected(self):
+        self.assertEqual(self.post(json.dumps(self.events(3))).status_code, 400)
+        self.assertEqual(RipplingWebhookEvent.objects.count(), 0)
+
+    @override_settings(RIPPLING_WEBHOOK_QUEUE_ENABLED=False)
+    def test_events_are_applied_inline_without_the_queue(self):
+        RipplingEmployee.objects.update(given_name='Old', updated_at=timezone.now() - timedelta(days=1))
+        self.assertEqual(self.post(json.dumps(self.events(1))).status_code, 200)
+        self.assertEqual(RipplingEmployee.objects.get().given_name, 'Given0')
+        self.assertEqual(RipplingWebhookEvent.objects.count(), 0)
+
+
+class IdempotencyStoreTests(RipplingTestCase):
+
+    def expire(self, key):
+        RipplingWebhookReceipt.objects.filter(key=key).update(
+            received_at=timezone.now() - timedelta(seconds=settings.RIPPLING_WEBHOOK_DEDUP_TTL + 1),
+        )
+        receipts.clear()
+
+    def test_key_is_claimed_once(self):
+        key = event_key('employee.updated', 'delivery-1')
+        self.assertTrue(receipts.claim(key))
+        self.assertFalse(receipts.claim(key))
+        self.assertTrue(receipts.claim(event_key('employee.updated', 'delivery-2')))
+
+    def test_duplicate_is_found_in_the_table_across_processes(self):
+        key = event_key('employee.updated', 'delivery-1')
+        self.assertTrue(receipts.claim(key))
+        receipts.clear()
+        self.assertFalse(receipts.claim(key))
+
+    def test_duplicate_is_answered_in_process_without_a_query(self):
+        key = event_key('employee.updated', 'delivery-1')
+        self.assertTrue(receipts.claim(key))
+        receipts._remember(key)
+        with self.assertNumQueries(0):
+            self.assertFalse(receipts.claim(key))
+
+    def test_released_key_is_claimed_again(self):
+        key = event_key('employee.updated', 'delivery-1')
+        self.assertTrue(receipts.claim(key))
+        receipts.release(key)
+        self.assertFalse(RipplingWebhookReceipt.objects.filter(key=key).exists())
+        self.assertTrue(receipts.claim(key))
+
+    def test_expired_receipt_is_taken_over(self):
+        key = event_key('employee.updated', 'delivery-1')
+        self.assertTrue(receipts.claim(key))
+        self.expire(key)
+        self.assertTrue(receipts.claim(key))
+        self.assertEqual(RipplingWebhookReceipt.objects.filter(key=key).count(), 1)
+        self.assertFalse(receipts.claim(key))
+
+    def test_purge_deletes_expired_receipts_only(self):
+        expired = event_key('employee.updated', 'delivery-1')
+        live = event_key('employee.updated', 'delivery-2')
+        receipts.claim(expired)
+        receipts.claim(live)
+        self.expire(expired)
+        self.assertEqual(purge_receipts(), 1)
+        self.assertEqual(list(RipplingWebhookReceipt.objects.values_list('key', flat=True)), [live])
+
+
+@override_settings(RIPPLING_WEBHOOK_DEDUP_ENABLED=True, RIPPLING_WEBHOOK_DELIVERY_ID_HEADER='X-Delivery-Id')
+class WebhookDeduplicationTests(RipplingTestCase):
+
+    url = '/integration/webhook/'
+
+    def post(self, delivery_id=None):
+        data = {'event_name': 'employee.updated', **self.event(self.directory.employee_id(self.company_id, 0))}
+        headers = {'X-Delivery-Id': delivery_id} if delivery_id else {}
+        return self.client.post(self.url, data, headers=headers)
+
+    def test_redelivery_is_acknowledged_without_being_queued(self):
+        self.assertEqual(self.post('delivery-1').json(), {'success': True})
+        self.assertEqual(self.post('delivery-1').json(), {'success': True, 'duplicate': True})
+        self.assertEqual(RipplingWebhookEvent.objects.count(), 1)
+
+    def test_new_deliveries_of_an_identical_payload_are_queued(self):
+        self.post('delivery-1')
+        self.post('delivery-2')
+        self.assertEqual(RipplingWebhookEvent.objects.count(), 2)
+
+    def test_events_without_a_delivery_id_are_never_dropped(self):
+        self.post()
+        self.post()
+        self.assertEqual(RipplingWebhookEvent.objects.count(), 2)
+        self.assertFalse(RipplingWebhookReceipt.objects.exists())
+
+    @override_settings(RIPPLING_WEBHOOK_DELIVERY_ID_HEADER='')
+    def test_nothing_is_dropped_without_a_delivery_id_header_setting(self):
+        self.post('delivery-1')
+        self.post('delivery-1')
+        self.assertEqual(RipplingWebhookEvent.objects.count(), 2)
+
+
+@override_settings(DATABASE_REPLICA='replica')
+class ReplicaRouterTests(SimpleTestCase):
+
+    def setUp(self):
+        self.router = ReplicaRouter()
+        self.state = _RequestState()
+        self.state.replica_reads = True
+        token = _request.set(self.state)
+        self.addCleanup(_request.reset, token)
+
+    def test_reads_go_to_the_replica_until_the_request_writes(self):
+        self.assertEqual(self.router.db_for_read(RipplingEmployee), 'replica')
+        self.assertIsNone(self.router.db_for_write(RipplingEmployee))
+        self.assertIsNone(self.router.db_for_read(RipplingEmployee))
+        self.assertIsNone(self.router.db_for_read(RipplingGroup))
+
+    def test_reads_stay_on_the_primary_without_replica_reads(self):
+        self.state.replica_reads = False
+        self.assertIsNone(self.router.db_for_read(RipplingEmployee))
+
+    def test_reads_outside_a_request_stay_on_the_primary(self):
+        token = _request.set(None)
+        self.addCleanup(_request.reset, token)
+        self.assertIsNone(self.router.db_for_read(RipplingEmployee))
+
+    def test_primary_only_apps_are_read_from_the_primary(self):
+        self.assertIsNone(self.router.db_for_read(get_user_model()))
+
+    def test_reads_inside_a_transaction_stay_on_the_primary(self):
+        with mock.patch.object(connection, 'in_atomic_block', True):
+            self.assertIsNone(self.router.db_for_read(RipplingEmployee))
+
+    @override_settings(DATABASE_REPLICA=None)
+    def test_everything_goes_to_the_primary_without_a_replica(self):
+        self.assertIsNone(self.router.db_for_read(RipplingEmployee))
+
+    def test_replica_is_never_migrated(self):
+        self.assertFalse(self.router.allow_migrate('replica', 'app'))
+        self.assertIsNone(self.router.allow_migrate('default', 'app'))
+
+    def test_middleware_allows_replica_reads_for_marked_get_views(self):
+        view = replica_reads(lambda request: None)
+        allowed = []
+
+        def get_response(request):
+            middleware.process_view(request, view, (), {})
+            allowed.append(_request.get().replica_reads)
+
+        middleware = ReplicaMiddleware(get_response)
+        for method in ('get', 'post'):
+            request = getattr(RequestFactory(), method)('/integration/employees/')
+            request.resolver_match = None
+            middleware(request)
+        self.assertEqual(allowed, [True, False])
+        self.assertIs(_request.get(), self.state)
+
+
+class DirectorySyncTests(RipplingTestCase):
+
+    def test_directory_is_stored(self):
+        result = sync_company_directory(self.company, batch_size=3)
+        self.assertEqual(result['employees'], {'created': 9, 'updated': 0, 'unchanged': 1})
+        self.assertEqual(result['groups'], {'created': 3, 'updated': 0, 'unchanged': 1})
+        self.assertEqual(RipplingEmployee.objects.count(), self.directory.employees)
+        self.assertEqual(RipplingGroup.objects.count(), self.directory.groups)
+        group = RipplingGroup.objects.get(group_id=self.directory.group_id(self.company_id, 1))
+        self.assertEqual(set(group_memberships(group).values_list('employee_id', flat=True)), set(group.users))
+
+    def test_second_sync_writes_nothing(self):
+        sync_company_directory(self.company)
+        with CaptureQueriesContext(connection) as queries:
+            result = sync_company_directory(self.company)
+        self.assertEqual(result['employees'], {'created': 0, 'updated': 0, 'unchanged': self.directory.employees})
+        self.assertFalse([query for query in queries if query['sql'].startswith(('INSERT', 'UPDATE', 'DELETE'))])
+
+    def test_command_requires_companies(self):
+        with self.assertRaises(CommandError):
+            call_command('sync_rippling_directory')
+        call_command('sync_rippling_directory', '--all', stdout=io.StringIO())
+        self.assertEqual(RipplingEmployee.objects.count(), self.directory.employees)
+
+
+class GroupSnapshotCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.cache = GroupSnapshotCache(max_companies=2)
+        self.fetches = 0
+        self.groups = [{'id': 'g1', 'name': 'One'}, {'id': 'g2', 'name': 'Two'}]
+
+    def fetch(self):
+        self.fetches += 1
+        return list(self.groups)
+
+    def test_one_fetch_serves_every_group_of_the_company(self):
+        self.assertEqual(self.cache.get('c1', 'g1', self.fetch)['name'], 'One')
+        self.assertEqual(self.cache.get('c1', 'g2', self.fetch)['name'], 'Two')
+        self.assertEqual(self.fetches, 1)
+
+    def test_events_received_after_the_fetch_refetch(self):
+        self.cache.get('c1', 'g1', self.fetch)
+        self.cache.get('c1', 'g1', self.fetch, fresh_after=timezone.now())
+        self.assertEqual(self.fetches, 2)
+
+    def test_missing_group_is_refetched_once(self):
+        self.cache.get('c1', 'g1', self.fetch)
+        self.groups.append({'id': 'g3', 'name': 'Three'})
+        self.assertEqual(self.cache.get('c1', 'g3', self.fetch)['name'], 'Three')
+        self.assertIsNone(self.cache.get('c1', 'g4', self.fetch))
+        self.assertEqual(self.fetches, 3)
+
+    @override_settings(RIPPLING_GROUP_CACHE_TTL=-1)
+    def test_expired_snapshot_is_refetched(self):
+        self.cache.get('c1', 'g1', self.fetch)
+        self.cache.get('c1', 'g1', self.fetch)
+        self.assertEqual(self.fetches, 2)
+
+    def test_invalidated_group_is_refetched(self):
+        self.cache.get('c1', 'g1', self.fetch)
+        self.cache.invalidate('c1', 'g1')
+        self.cache.get('c1', 'g2', self.fetch)
+        self.cache.get('c1', 'g1', self.fetch)
+        self.assertEqual(self.fetches, 2)
+
+    def test_least_recently_used_company_is_evicted(self):
+        for company_id in ('c1', 'c2', 'c1', 'c3', 'c1', 'c2'):
+            self.cache.get(company_id, 'g1', self.fetch)
+        self.assertEqual(self.fetches, 4)
+
+    def test_concurrent_misses_share_one_fetch(self):
+        release = threading.Event()
+
+        def slow_fetch():
+            release.wait(1)
+            return self.fetch()
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [executor.submit(self.cache.get, 'c1', 'g1', slow_fetch) for _ in range(4)]
+            time.sleep(0.05)
+            release.set()
+            results = [future.result() for future in futures]
+        self.assertEqual(results, [self.groups[0]] * 4)
+        self.assertEqual(self.fetches, 1)
+
+
+class CompanyResolverTests(RipplingTestCase):
+
+    def test_cached_company_is_resolved_without_queries(self):
+        self.assertEqual(companies.resolve(self.company_id, self.company.primary_email), self.company)
+        with self.assertNumQueries(0):
+            self.assertEqual(companies.resolve(self.company_id, self.company.primary_email).pk, self.company.pk)
+
+    def test_changed_primary_email_is_written(self):
+        companies.resolve(self.company_id)
+        with self.assertNumQueries(1):
+            company = companies.resolve(self.company_id, 'new@example.com')
+        self.assertEqual(company.primary_email, 'new@example.com')
+        self.assertEqual(RipplingCompany.objects.get().primary_email, 'new@example.com')
+
+    def test_unknown_company_is_created(self):
+        company = companies.resolve('other', 'other@example.com')
+        self.assertEqual(RipplingCompany.objects.get(company_id='other').pk, company.pk)
+        self.assertEqual(company.primary_email, 'other@example.com')
+
+    def test_invalidated_company_is_read_again(self):
+        companies.resolve(self.company_id)
+        RipplingCompany.objects.update(company_name='Renamed')
+        self.assertEqual(companies.resolve(self.company_id).company_name, 'Company')
+        companies.invalidate(self.company_id)
+        self.assertEqual(companies.resolve(self.company_id).company_name, 'Renamed')
+
+    @override_settings(RIPPLING_COMPANY_CACHE_TTL=-1)
+    def test_expired_company_is_read_again(self):
+        companies.resolve(self.company_id)
+        with self.assertNumQueries(1):
+            companies.resolve(self.company_id)
+
+
+class TransportTests(SimpleTestCase):
+
+    def setUp(self):
+        transport.close_session()
+        self.addCleanup(transport.close_session)
+
+    def test_session_is_shared(self):
+        self.assertIs(transport.get_session(), transport.get_session())
+
+    def test_session_is_rebuilt_after_a_fork(self):
+        session = transport.get_session()
+        with mock.patch.object(transport.os, 'getpid', return_value=-1):
+            self.assertIsNot(transport.get_session(), session)
+
+    @override_settings(RIPPLING_HTTP_POOL_SIZE=7, RIPPLING_HTTP_MAX_RETRIES=2)
+    def test_pool_and_retries_come_from_settings(self):
+        adapter = transport.get_session().get_adapter(BASE_URL)
+        self.assertEqual(adapter._pool_maxsize, 7)
+        self.assertEqual(adapter.max_retries.total, 2)
+        self.assertTrue(adapter.max_retries.is_retry('GET', 503))
+        self.assertFalse(adapter.max_retries.is_retry('POST', 503))
+
+    @override_settings(RIPPLING_HTTP_CONNECT_TIMEOUT=2, RIPPLING_HTTP_READ_TIMEOUT=9)
+    def test_requests_carry_the_timeouts(self):
+        with mock.patch.object(transport.get_session(), 'request') as request:
+            transport.request('GET', BASE_URL, params={'limit': 1})
+        self.assertEqual(request.call_args.kwargs['timeout'], (2, 9))
+
+
+class TokenRefreshSchedulerTests(RipplingTestCase):
+
+    def expire_in(self, seconds):
+        RipplingCompany.objects.update(expires_at=timezone.now() + timedelta(seconds=seconds))
+
+    def test_set_token_stores_an_absolute_expiry(self):
+        before = timezone.now()
+        self.company.set_token({'access_token': 'new', 'expires_in': 3600})
+        self.assertEqual(self.company.refresh_token, 'refresh')
+        self.assertGreaterEqual(self.company.expires_at, before + timedelta(seconds=3600))
+        self.assertLessEqual(self.company.expires_at, timezone.now() + timedelta(seconds=3600))
+
+    def test_tokens_are_due_within_the_lead_and_their_offset(self):
+        self.expire_in(3600)
+        self.assertEqual(due_companies(lead=600, spread=600), [])
+        self.expire_in(599)
+        self.assertEqual(due_companies(lead=600, spread=600), [self.company_id])
+
+    def test_companies_without_a_refresh_token_are_skipped(self):
+        RipplingCompany.objects.update(refresh_token=None)
+        self.assertEqual(due_companies(lead=600, spread=600), [])
+
+    def test_due_tokens_are_refreshed(self):
+        call_command('refresh_rippling_tokens', '--once', stdout=io.StringIO())
+        company = RipplingCompany.objects.get()
+        self.assertEqual(company.access_token, f'token:{self.company_id}:0')
+        self.assertGreater(company.expires_at, timezone.now() + timedelta(minutes=59))
+        self.assertEqual(due_companies(lead=600, spread=600), [])
+
+
+class InstallTests(RipplingTestCase):
+
+    def install(self, index):
+        return self.client.get('/integration/install/', {'code': self.directory.code(self.company_id, index)})
+
+    def test_install_stores_the_company_and_installer(self):
+        response = self.install(1)
+        self.assertEqual(response.status_code, 302)
+        company = RipplingCompany.objects.get()
+        self.assertEqual(company.pk, self.company.pk)
+        self.assertEqual(company.access_token, f'token:{self.company_id}:1')
+        self.assertEqual(company.company_name, self.directory.company(self.company_id)['name'])
+        self.assertGreater(company.expires_at, timezone.now())
+        installer = self.directory.user_info(self.company_id, 1)
+        self.assertEqual(RipplingEmployee.objects.get(employee_id=installer['sub']).given_name, installer['given_name'])
+
+    def test_install_sends_each_api_request_once(self):
+        self.install(1)
+        self.assertEqual(sorted(urlsplit(url).path for method, url in self.transport.requests), [
+            '/api/o/token/',
+            '/platform/api/companies/current',
+            '/platform/api/me',
+            '/platform/api/userinfo',
+        ])
+
+    def test_reinstall_replaces_the_cached_token(self):
+        rippling = RipplingIntegration()
+        self.install(1)
+        self.assertEqual(rippling.get_company_access_token(self.company_id), f'token:{self.company_id}:1')
+        self.install(2)
+        self.assertEqual(rippling.get_company_access_token(self.company_id), f'token:{self.company_id}:2')
+
+
+class MetricsTests(SimpleTestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_counter_is_rendered_per_label_set(self):
+        counter = metrics.Counter('requests_total', 'Requests.', ['status'], registry=self.registry)
+        counter.inc(status=200)
+        counter.inc(2, status=200)
+        counter.inc(status='5"0')
+        self.assertEqual(self.registry.render(), (
+            '# HELP requests_total Requests.\n'
+            '# TYPE requests_total counter\n'
+            'requests_total{status="200"} 3\n'
+            'requests_total{status="5\\"0"} 1\n'
+        ))
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = metrics.Histogram('duration_seconds', 'Duration.', buckets=(0.1, 1), registry=self.registry)
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value)
+        self.assertEqual(self.registry.render().splitlines()[2:], [
+            'duration_seconds_bucket{le="0.1"} 1',
+            'duration_seconds_bucket{le="1.0"} 2',
+            'duration_seconds_bucket{le="+Inf"} 3',
+            'duration_seconds_count 3',
+            'duration_seconds_sum 5.55',
+        ])
+
+    def test_samples_of_finished_threads_are_kept(self):
+        counter = metrics.Counter('events_total', 'Events.', registry=self.registry)
+        threads = [threading.Thread(target=counter.inc) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+            thread.join()
+        counter.inc()
+        self.assertEqual(self.registry.collect(counter), {(): 5})
+        self.assertEqual(len(self.registry._shards), 1)
+
+    def test_endpoint_label_hides_object_ids(self):
+        self.assertEqual(
+            metrics.endpoint_label(f'{BASE_URL}/platform/api/employees/company0000-e000001?limit=1'),
+            '/platform/api/employees/:id',
+        )
+        self.assertEqual(metrics.endpoint_label(f'{BASE_URL}/platform/api/groups'), '/platform/api/groups')
+
+
+class MetricsViewTests(RipplingTestCase):
+
+    def test_metrics_are_hidden_unless_enabled(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+    @override_settings(METRICS_ENABLED=True)
+    def test_api_requests_are_exposed(self):
+        RipplingIntegration().get_company_access_token(self.company_id)
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('rippling_api_requests_total{method="POST",endpoint="/api/o/token/",status="200"}', response.content.decode())
+
+
+class DatabaseConfigurationTests(TestCase):
+
+    def pragma(self, name):
+        with connection.cursor() as cursor:
+            cursor.execute(f'PRAGMA {name}')
+            return cursor.fetchone()[0]
+
+    def test_sqlite_connections_get_the_pragmas(self):
+        self.assertEqual(self.pragma('synchronous'), 1)
+        self.assertEqual(self.pragma('busy_timeout'), settings.SQLITE_BUSY_TIMEOUT)
+
+    @override_settings(SQLITE_JOURNAL_MODE='delete', SQLITE_SYNCHRONOUS='full', SQLITE_BUSY_TIMEOUT=1234)
+    def test_pragmas_come_from_settings(self):
+        # a pragma changing the safety level cannot run inside the test transaction
+        sqlite = mock.MagicMock(vendor='sqlite')
+        configure_sqlite(None, sqlite)
+        cursor = sqlite.cursor.return_value.__enter__.return_value
+        self.assertEqual([call.args[0] for call in cursor.execute.call_args_list], [
+            'PRAGMA journal_mode=delete',
+            'PRAGMA synchronous=full',
+            'PRAGMA busy_timeout=1234',
+        ])
+
+    def test_other_databases_are_left_alone(self):
+        other = mock.Mock(vendor='postgresql')
+        configure_sqlite(None, other)
+        other.cursor.assert_not_called()
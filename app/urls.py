@@ -2,11 +2,19 @@ from django.urls import path
 from django.views.decorators.csrf import csrf_exempt
 
 # views
-from .views import handle_app_install, handle_oauth_login, handle_incoming_webhook, secure_page
+from .views import (
+    handle_app_install, handle_oauth_login, handle_incoming_webhook, handle_incoming_webhook_batch, secure_page,
+    company_employees, company_groups, group_members, employee_groups,
+)
 
 urlpatterns = [
     path('install/', handle_app_install),
     path('sso/', csrf_exempt(handle_oauth_login)),
     path('webhook/', csrf_exempt(handle_incoming_webhook)),
+    path('webhook/batch/', csrf_exempt(handle_incoming_webhook_batch)),
     path('secure-page/', csrf_exempt(secure_page)),
+    path('api/companies/<str:company_id>/employees/', company_employees),
+    path('api/companies/<str:company_id>/employees/<str:employee_id>/groups/', employee_groups),
+    path('api/companies/<str:company_id>/groups/', company_groups),
+    path('api/companies/<str:company_id>/groups/<str:group_id>/members/', group_members),
 ]
\ No newline at end of file
@@ -1,21 +1,40 @@
-import json
+import functools
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth import login
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse, Http404, JsonResponse
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
 from django.http.response import HttpResponseRedirect
 
+from app.lib import memberships, metrics
+from app.lib.cache import companies
+from app.lib.changes import diff_fields
+from app.lib.idempotency import event_key, receipts
+from app.lib.mappers import INSTALL_COMPANY_FIELDS, employee_values, user_info_values
+from app.lib.metrics import observe_view
 from app.lib.rippling import RipplingIntegration
-from app.models import RipplingCompany, RipplingEmployee
+from app.lib.routers import replica_reads
+from app.lib.serializers import serialize_queryset
+from app.lib.sync import sync_webhook_events
+from app.lib.tokens import access_tokens
+from app.lib.transport import RipplingAPIError
+from app.lib.webhooks import EVENT_MAPPING, dispatch_event, enqueue_event, enqueue_events, parse_events
+from app.models import RipplingCompany, RipplingEmployee, RipplingGroup
 
 
 # Create your views here.
 
+@observe_view
 def handle_app_install(request):
     rippling = RipplingIntegration()
-    oauth_data = rippling.handle_oauth_redirect(request)
+    try:
+        oauth_data = rippling.handle_oauth_redirect(request)
+    except RipplingAPIError as e:
+        oauth_data = {'error': str(e)}
 
     if not oauth_data or oauth_data and 'error' in oauth_data:
         return JsonResponse({
@@ -23,70 +42,38 @@ def handle_app_install(request):
             "oauth_data": oauth_data
         })
 
-    # get the current user
-    current_user = rippling.get_current_user()
-
-    # update the RipplingCompany data
-    company_record = RipplingCompany.objects.get_or_create(
-        company_id=current_user['company']
-    )[0]
-    company_record.access_token = oauth_data['access_token']
-    company_record.refresh_token = oauth_data['refresh_token']
-    company_record.expires_in = oauth_data['expires_in']
-    company_record.scope = oauth_data['scope']
-    company_record.save()
-
-    # update the RipplingEmployee data
-    user_info = rippling.get_user_info()
-    company_employee = RipplingEmployee.objects.get_or_create(
-        company=company_record,
-        employee_id=user_info['sub']
-    )[0]
-    company_employee.role_id = user_info['role_id']
-    company_employee.picture = user_info['picture']
-    company_employee.name = user_info['name']
-    company_employee.family_name = user_info['family_name']
-    company_employee.given_name = user_info['given_name']
-    company_employee.birthdate = user_info['birthdate']
-    company_employee.gender = user_info['gender']
-    company_employee.email = user_info['email']
-    company_employee.email_verified = user_info['email_verified']
-    address = json.loads(user_info['address'])
-    company_employee.street_address = address['street_address']
-    company_employee.locality = address['locality']
-    company_employee.region = address['region']
-    company_employee.postal_code = address['postal_code']
-    company_employee.country = address['country']
-    company_employee.phone_number = user_info['phone_number']
-    company_employee.phone_number_verified = user_info['phone_number_verified']
-    company_employee.save()
-
-    # Refresh the access token
-    refresh_token = oauth_data.get('refresh_token')
-    if refresh_token:
-        refresh_response = rippling.refresh_token(refresh_token)
-        # update the company record
-        company_record = RipplingCompany.objects.get_or_create(company_id=current_user['company'])[0]
-        company_record.access_token = refresh_response.get('access_token')
-        company_record.save()
-
-        company_employee.access_token = refresh_response.get('access_token')
-        company_employee.save()
-
-        # update the current access token
-        rippling.access_token = refresh_response.get('access_token')
-
-    # make the first API call
-    current_company = rippling.get_current_company()
-
-    # update the RipplingCompany data
-    company_record.company_name = current_company['name']
-    company_record.primary_email = current_company['primaryEmail']
-    company_record.save()
+    # the remaining calls only need the new access token, run them together
+    current_user, user_info, current_company = [
+        future.result() for future in (
+            rippling.submit(rippling.get_current_user),
+            rippling.submit(rippling.get_user_info),
+            rippling.submit(rippling.get_current_company),
+        )
+    ]
+
+    # update the RipplingCompany and RipplingEmployee data
+    company_record = RipplingCompany(
+        company_id=current_user['company'],
+        company_name=current_company['name'],
+        primary_email=current_company['primaryEmail'],
+    )
+    company_record.set_token(oauth_data)
+    with transaction.atomic():
+        company_record = RipplingCompany.objects.bulk_upsert([company_record], ['company_id'], INSTALL_COMPANY_FIELDS)[0]
+        RipplingEmployee.objects.upsert(
+            company=company_record,
+            employee_id=user_info['sub'],
+            defaults=user_info_values(user_info),
+        )
+    access_tokens.invalidate(company_record.company_id)
+    companies.invalidate(company_record.company_id)
 
+    # no refresh here: the token was just issued and the refresh_rippling_tokens
+    # scheduler renews it ahead of expiry
     return HttpResponseRedirect(f'https://app.rippling.com/apps/{settings.RIPPLING_APP_SLUG}/settings')
 
 
+@observe_view
 def handle_oauth_login(request):
     rippling = RipplingIntegration()
 
@@ -97,36 +84,52 @@ def handle_oauth_login(request):
     if not code:
         return JsonResponse({'error': 'No code provided.'})
 
-    oauth_data = rippling.handle_oauth_redirect(request, code)
-    current_user = rippling.get_current_user()
+    with rippling.memoize():
+        try:
+            oauth_data = rippling.handle_oauth_redirect(request, code)
+            current_user = rippling.get_current_user()
+        except RipplingAPIError as e:
+            return JsonResponse({'error': str(e)})
 
-    # try to find the employee record
-    employee_record = None
-    try:
-        employee_record = RipplingEmployee.objects.get(employee_id=current_user.get('id'))
-    except:
-        # find the commpany record
-        company_record = None
+        # the employee details only need the user id, fetch them while the
+        # database lookups below run
+        employee_future = rippling.submit(rippling.get_employee, current_user.get('id'))
+
+        # try to find the employee record
+        employee_record = None
         try:
-            company_record = RipplingCompany.objects.get(company_id=current_user.get('company'))
+            employee_record = RipplingEmployee.objects.select_related('company', 'user').get(employee_id=current_user.get('id'))
         except:
-            return JsonResponse({'error': 'Company not found.'})
-        # creaet the employee record
-        employee_record = RipplingEmployee.objects.create(
-            company=company_record,
-            employee_id=current_user.get('id'),
-            role_id=role_id
-        )
-
-    # get the userinfo
-    user_info = rippling.get_employee(employee_record.employee_id)
-    current_user = rippling.get_current_user()
-    employee_record.given_name = user_info.get('firstName')
-    employee_record.family_name = user_info.get('lastName')
-    employee_record.email = current_user.get('workEmail')
-    employee_record.updated_at = user_info.get('updatedAt')
-    employee_record.created_at = user_info.get('createdAt')
-    employee_record.save(update_fields=['given_name', 'family_name', 'email', 'updated_at', 'created_at'])
+            # find the commpany record
+            company_record = None
+            try:
+                company_record = RipplingCompany.objects.get(company_id=current_user.get('company'))
+            except:
+                return JsonResponse({'error': 'Company not found.'})
+            # creaet the employee record
+            try:
+                with transaction.atomic():
+                    employee_record = RipplingEmployee.objects.create(
+                        company=company_record,
+                        employee_id=current_user.get('id'),
+                        role_id=role_id
+                    )
+            except IntegrityError:
+                # a concurrent first login of the same employee created it
+                employee_record = RipplingEmployee.objects.select_related('company', 'user').get(
+                    company=company_record,
+                    employee_id=current_user.get('id'),
+                )
+
+        # get the userinfo
+        user_info = employee_future.result()
+        values = employee_values(user_info)
+        values['email'] = current_user.get('workEmail')
+        changed = diff_fields(employee_record, values)
+        if changed:
+            for field, value in changed.items():
+                setattr(employee_record, field, value)
+            employee_record.save(update_fields=list(changed))
 
     # if the employee record doesn't have a user, create one
     if not employee_record.user:
@@ -136,12 +139,17 @@ def handle_oauth_login(request):
             employee_record.save()
         except:
             # create the user
-            user = get_user_model().objects.create_user(
-                username=f"{employee_record.employee_id}:{employee_record.company.company_id}",
-                email=employee_record.email,
-                first_name=employee_record.given_name,
-                last_name=employee_record.family_name,
-            )
+            try:
+                with transaction.atomic():
+                    user = get_user_model().objects.create_user(
+                        username=f"{employee_record.employee_id}:{employee_record.company.company_id}",
+                        email=employee_record.email,
+                        first_name=employee_record.given_name,
+                        last_name=employee_record.family_name,
+                    )
+            except IntegrityError:
+                # a concurrent first login of the same employee created it
+                user = get_user_model().objects.get(username=f"{employee_record.employee_id}:{employee_record.company.company_id}")
             employee_record.user = user
             employee_record.save()
 
@@ -149,36 +157,176 @@ def handle_oauth_login(request):
     return HttpResponseRedirect('/integration/secure-page/')
 
 
+@observe_view
 def handle_incoming_webhook(request):
     """
     Handle incoming webhooks from Rippling.
-    """
 
-    event_mapping = {
-        'employee.created': '_webhook_employee_created',
-        'employee.updated': '_webhook_employee_updated',
-        'employee.deleted': '_webhook_employee_deleted',
-        'company.updated': '_webhook_company_updated',
-        'company.deleted': '_webhook_company_deleted',
-        'company.created': '_webhook_company_created',
-        'group.updated': '_webhook_group_updated',
-        'group.created': '_webhook_group_created',
-        'group.deleted': '_webhook_group_deleted',
-    }
+    Events are persisted for the process_rippling_webhooks worker and the
+    request returns immediately, unless the queue is disabled in settings.
+    Redeliveries of an event that was already accepted, recognised by their
+    delivery id header, are acknowledged without being handled again.
+    """
 
     event_name = request.POST.get('event_name')
 
-    if event_name in event_mapping:
-        rippling = RipplingIntegration()
-        method = getattr(rippling, event_mapping[event_name])
-        method(request.POST)
+    if event_name in EVENT_MAPPING:
+        data = request.POST.dict()
+        key = None
+        if settings.RIPPLING_WEBHOOK_DEDUP_ENABLED and settings.RIPPLING_WEBHOOK_DELIVERY_ID_HEADER:
+            delivery_id = request.headers.get(settings.RIPPLING_WEBHOOK_DELIVERY_ID_HEADER)
+            key = event_key(event_name, delivery_id) if delivery_id else None
+        if key and not receipts.claim(key):
+            return JsonResponse({'success': True, 'duplicate': True})
+        try:
+            if settings.RIPPLING_WEBHOOK_QUEUE_ENABLED:
+                enqueue_event(event_name, data)
+            else:
+                # only group snapshots fetched after this event was received may serve it
+                dispatch_event(event_name, data, received_at=timezone.now())
+        except Exception:
+            # let Rippling's redelivery of this event through
+            if key:
+                receipts.release(key)
+            raise
 
     return JsonResponse({'success': True})
 
 
+@observe_view
+def handle_incoming_webhook_batch(request):
+    """
+    Handle many webhook events in one request.
+
+    The body is a JSON array of events, or one JSON event per line, each in
+    the shape of a single webhook POST. Events are queued with one bulk
+    insert, or applied in bulk per company when the queue is disabled.
+    """
+
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST required'}, status=405)
+
+    try:
+        events = parse_events(request.body)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    if len(events) > settings.RIPPLING_WEBHOOK_BATCH_MAX_EVENTS:
+        return JsonResponse({'error': f'At most {settings.RIPPLING_WEBHOOK_BATCH_MAX_EVENTS} events per request'}, status=400)
+
+    events = [event for event in events if event.get('event_name') in EVENT_MAPPING]
+    if settings.RIPPLING_WEBHOOK_QUEUE_ENABLED:
+        enqueue_events(events)
+    else:
+        sync_webhook_events(events)
+
+    return JsonResponse({'success': True, 'events': len(events)})
+
+
+@replica_reads
+@observe_view
 @login_required
 def secure_page(request):
     """
     A secure page that requires a logged in user.
     """
     return JsonResponse({'success': True, 'user': request.user.id})
+
+
+EMPLOYEE_API_FIELDS = ['id', 'employee_id', 'name', 'given_name', 'family_name', 'email', 'role_id', 'updated_at']
+GROUP_API_FIELDS = ['id', 'group_id', 'name', 'version', 'updated_at']
+
+
+def _keyset_page(request, queryset, fields):
+    """
+    Return one page of `queryset` ordered by primary key, starting after the
+    `cursor` query parameter, and the cursor of the next page if any.
+    """
+    limit = min(int(request.GET.get('limit', settings.RIPPLING_API_PAGE_SIZE)), settings.RIPPLING_API_MAX_PAGE_SIZE)
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    cursor = request.GET.get('cursor')
+    if cursor:
+        queryset = queryset.filter(pk__gt=int(cursor))
+    rows = serialize_queryset(queryset.order_by('pk')[:limit + 1], fields)
+    next_cursor = rows[limit - 1]['id'] if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+def _directory_view(view):
+    """
+    Resolve the company of a directory view, check that the user may read
+    it and turn bad pagination parameters into a 400.
+    """
+    @functools.wraps(view)
+    @login_required
+    def wrapper(request, company_id, *args, **kwargs):
+        company = get_object_or_404(RipplingCompany.objects.only('id'), company_id=company_id)
+        if not request.user.is_staff and not RipplingEmployee.objects.filter(company=company, user=request.user).exists():
+            return JsonResponse({'error': 'Company not found.'}, status=404)
+        try:
+            results, next_cursor = view(request, company, *args, **kwargs)
+        except ValueError:
+            return JsonResponse({'error': 'Invalid cursor or limit.'}, status=400)
+        return JsonResponse({'results': results, 'next_cursor': next_cursor})
+    return wrapper
+
+
+@replica_reads
+@observe_view
+@_directory_view
+def company_employees(request, company):
+    """
+    List the employees of a company.
+    """
+    return _keyset_page(request, RipplingEmployee.objects.filter(company=company), EMPLOYEE_API_FIELDS)
+
+
+@replica_reads
+@observe_view
+@_directory_view
+def company_groups(request, company):
+    """
+    List the groups of a company.
+    """
+    return _keyset_page(request, RipplingGroup.objects.filter(company=company), GROUP_API_FIELDS)
+
+
+@replica_reads
+@observe_view
+@_directory_view
+def group_members(request, company, group_id):
+    """
+    List the members of a group, with employee details when the employee is
+    known. Details for a page are loaded with one query.
+    """
+    group = get_object_or_404(RipplingGroup.objects.only('id'), company=company, group_id=group_id)
+    rows, next_cursor = _keyset_page(request, memberships.group_memberships(group), ['id', 'employee_id'])
+    employees = {
+        employee['employee_id']: employee
+        for employee in serialize_queryset(
+            RipplingEmployee.objects.filter(company=company, employee_id__in=[row['employee_id'] for row in rows]),
+            EMPLOYEE_API_FIELDS,
+        )
+    }
+    results = [employees.get(row['employee_id'], {'employee_id': row['employee_id']}) for row in rows]
+    return results, next_cursor
+
+
+@replica_reads
+@observe_view
+@_directory_view
+def employee_groups(request, company, employee_id):
+    """
+    List the groups an employee belongs to.
+    """
+    return _keyset_page(request, memberships.employee_groups(company, employee_id), GROUP_API_FIELDS)
+
+
+def metrics_view(request):
+    """
+    Expose the process metrics in the Prometheus text format.
+    """
+    if not settings.METRICS_ENABLED:
+        raise Http404
+    return HttpResponse(metrics.REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
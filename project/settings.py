@@ -12,6 +12,8 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 import os
 from pathlib import Path
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -56,6 +58,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'app.lib.profiling.ProfilingMiddleware',
+    'app.lib.routers.ReplicaMiddleware',
 ]
 
 ROOT_URLCONF = 'project.urls'
@@ -82,12 +86,75 @@ WSGI_APPLICATION = 'project.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# DATABASE_ENGINE selects 'sqlite' (the default) or 'postgres', which need
+# psycopg from requirments.txt; the Django backend names 'sqlite3' and
+# 'postgresql' are accepted too. SQLite runs in
+# WAL mode with a busy timeout so concurrent webhook writers wait for the
+# write lock instead of failing; the pragmas are applied on connect by
+# app.lib.database. Connections are kept open for DATABASE_CONN_MAX_AGE
+# seconds and health checked before reuse.
+DATABASE_ENGINE = os.environ.get('DATABASE_ENGINE', 'sqlite').lower()
+DATABASE_ENGINE = {'sqlite3': 'sqlite', 'postgresql': 'postgres'}.get(DATABASE_ENGINE, DATABASE_ENGINE)
+if DATABASE_ENGINE not in ('sqlite', 'postgres'):
+    raise ImproperlyConfigured(f"Unknown DATABASE_ENGINE {DATABASE_ENGINE!r}, expected 'sqlite' or 'postgres'")
+DATABASE_CONN_MAX_AGE = int(os.environ.get('DATABASE_CONN_MAX_AGE', 60))
+
+SQLITE_PATH = os.environ.get('SQLITE_PATH', BASE_DIR / 'db.sqlite3')
+SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE', 'wal')
+SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'normal')
+SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000))
+
+if DATABASE_ENGINE == 'postgres':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('POSTGRES_DB', 'rippling'),
+            'USER': os.environ.get('POSTGRES_USER', 'postgres'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'connect_timeout': int(os.environ.get('POSTGRES_CONNECT_TIMEOUT', 5)),
+            },
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': SQLITE_PATH,
+            'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                # seconds the sqlite3 module waits for a lock
+                'timeout': SQLITE_BUSY_TIMEOUT / 1000,
+            },
+        }
+    }
+
+# Optional read replica, configured with POSTGRES_REPLICA_HOST (or
+# SQLITE_REPLICA_PATH). Reads of admin GETs and views marked with
+# app.lib.routers.replica_reads go to it until the request writes.
+DATABASE_REPLICA = None
+if DATABASE_ENGINE == 'postgres' and os.environ.get('POSTGRES_REPLICA_HOST'):
+    DATABASE_REPLICA = os.environ.get('DATABASE_REPLICA_ALIAS', 'replica')
+    DATABASES[DATABASE_REPLICA] = {
+        **DATABASES['default'],
+        'HOST': os.environ.get('POSTGRES_REPLICA_HOST'),
+        'PORT': os.environ.get('POSTGRES_REPLICA_PORT', DATABASES['default']['PORT']),
+        'TEST': {'MIRROR': 'default'},
+    }
+elif DATABASE_ENGINE == 'sqlite' and os.environ.get('SQLITE_REPLICA_PATH'):
+    DATABASE_REPLICA = os.environ.get('DATABASE_REPLICA_ALIAS', 'replica')
+    DATABASES[DATABASE_REPLICA] = {
+        **DATABASES['default'],
+        'NAME': os.environ.get('SQLITE_REPLICA_PATH'),
+        'TEST': {'MIRROR': 'default'},
     }
-}
+
+DATABASE_ROUTERS = ['app.lib.routers.ReplicaRouter']
 
 
 # Password validation
@@ -135,4 +202,91 @@ RIPPLING_CLIENT_ID = os.environ.get('RIPPLING_CLIENT_ID', 'xxx')
 RIPPLING_CLIENT_SECRET = os.environ.get('RIPPLING_CLIENT_SECRET', 'xxx')
 RIPPLING_REDIRECT_URI = os.environ.get('RIPPLING_REDIRECT_URI', 'https://4b30-173-56-106-87.ngrok-free.app/integration/install/')
 RIPPLING_BASE_URL = os.environ.get('RIPPLING_BASE_URL', 'https://api.rippling.com')
-RIPPLING_APP_SLUG = os.environ.get('RIPPLING_APP_SLUG', 'asaftest9f30')
\ No newline at end of file
+RIPPLING_APP_SLUG = os.environ.get('RIPPLING_APP_SLUG', 'asaftest9f30')
+
+# Pooled HTTP transport used for every call to the Rippling API
+RIPPLING_HTTP_POOL_CONNECTIONS = int(os.environ.get('RIPPLING_HTTP_POOL_CONNECTIONS', 4))
+RIPPLING_HTTP_POOL_SIZE = int(os.environ.get('RIPPLING_HTTP_POOL_SIZE', 20))
+RIPPLING_HTTP_CONNECT_TIMEOUT = float(os.environ.get('RIPPLING_HTTP_CONNECT_TIMEOUT', 3.05))
+RIPPLING_HTTP_READ_TIMEOUT = float(os.environ.get('RIPPLING_HTTP_READ_TIMEOUT', 30))
+RIPPLING_HTTP_MAX_RETRIES = int(os.environ.get('RIPPLING_HTTP_MAX_RETRIES', 3))
+RIPPLING_HTTP_RETRY_BACKOFF = float(os.environ.get('RIPPLING_HTTP_RETRY_BACKOFF', 0.5))
+
+# Client-side rate limiting per company: sustained requests per second, burst
+# size, and the ceiling of the adaptive in-flight limit. Throttled (429)
+# requests are retried after Retry-After, or an exponential backoff from
+# RIPPLING_RATE_LIMIT_BACKOFF seconds when the header is missing. A request
+# never waits longer than RIPPLING_RATE_LIMIT_MAX_WAIT seconds for the limit,
+# it fails with RipplingRateLimitError instead
+RIPPLING_RATE_LIMIT_RATE = float(os.environ.get('RIPPLING_RATE_LIMIT_RATE', 10))
+RIPPLING_RATE_LIMIT_BURST = int(os.environ.get('RIPPLING_RATE_LIMIT_BURST', 20))
+RIPPLING_RATE_LIMIT_MAX_CONCURRENCY = int(os.environ.get('RIPPLING_RATE_LIMIT_MAX_CONCURRENCY', 10))
+RIPPLING_RATE_LIMIT_MAX_RETRIES = int(os.environ.get('RIPPLING_RATE_LIMIT_MAX_RETRIES', 3))
+RIPPLING_RATE_LIMIT_BACKOFF = float(os.environ.get('RIPPLING_RATE_LIMIT_BACKOFF', 1))
+RIPPLING_RATE_LIMIT_MAX_WAIT = float(os.environ.get('RIPPLING_RATE_LIMIT_MAX_WAIT', 10))
+
+# Threads used to overlap blocking Rippling calls, and the default number of
+# in-flight requests per AsyncRipplingIntegration
+RIPPLING_ASYNC_CONCURRENCY = int(os.environ.get('RIPPLING_ASYNC_CONCURRENCY', 10))
+
+# Number of records requested per page by the streaming iterators
+RIPPLING_PAGE_SIZE = int(os.environ.get('RIPPLING_PAGE_SIZE', 100))
+
+# Rows written per transaction by the bulk directory sync
+RIPPLING_SYNC_BATCH_SIZE = int(os.environ.get('RIPPLING_SYNC_BATCH_SIZE', 500))
+
+# Background processing of incoming webhooks
+RIPPLING_WEBHOOK_QUEUE_ENABLED = os.environ.get('RIPPLING_WEBHOOK_QUEUE_ENABLED', 'true').lower() == 'true'
+RIPPLING_WEBHOOK_WORKERS = int(os.environ.get('RIPPLING_WEBHOOK_WORKERS', 4))
+RIPPLING_WEBHOOK_WORKER_POOL = os.environ.get('RIPPLING_WEBHOOK_WORKER_POOL', 'thread')
+RIPPLING_WEBHOOK_POLL_INTERVAL = float(os.environ.get('RIPPLING_WEBHOOK_POLL_INTERVAL', 1))
+RIPPLING_WEBHOOK_LOCK_TIMEOUT = int(os.environ.get('RIPPLING_WEBHOOK_LOCK_TIMEOUT', 300))
+RIPPLING_WEBHOOK_MAX_ATTEMPTS = int(os.environ.get('RIPPLING_WEBHOOK_MAX_ATTEMPTS', 8))
+RIPPLING_WEBHOOK_RETRY_BACKOFF = float(os.environ.get('RIPPLING_WEBHOOK_RETRY_BACKOFF', 5))
+RIPPLING_WEBHOOK_RETRY_MAX_DELAY = float(os.environ.get('RIPPLING_WEBHOOK_RETRY_MAX_DELAY', 900))
+RIPPLING_WEBHOOK_RETENTION = int(os.environ.get('RIPPLING_WEBHOOK_RETENTION', 7 * 24 * 3600))
+RIPPLING_WEBHOOK_COALESCE_WINDOW = float(os.environ.get('RIPPLING_WEBHOOK_COALESCE_WINDOW', 2))
+# Largest number of events accepted by one request to the batch endpoint
+RIPPLING_WEBHOOK_BATCH_MAX_EVENTS = int(os.environ.get('RIPPLING_WEBHOOK_BATCH_MAX_EVENTS', 5000))
+
+# Redelivered webhooks are dropped when an event with the same delivery id,
+# read from the RIPPLING_WEBHOOK_DELIVERY_ID_HEADER request header, was
+# received within RIPPLING_WEBHOOK_DEDUP_TTL seconds; the cache size bounds the
+# in-process LRU. Webhook payloads carry nothing that tells a redelivery from
+# a new event about the same object, so without the header nothing is dropped.
+RIPPLING_WEBHOOK_DEDUP_ENABLED = os.environ.get('RIPPLING_WEBHOOK_DEDUP_ENABLED', 'true').lower() == 'true'
+RIPPLING_WEBHOOK_DELIVERY_ID_HEADER = os.environ.get('RIPPLING_WEBHOOK_DELIVERY_ID_HEADER', '')
+RIPPLING_WEBHOOK_DEDUP_TTL = int(os.environ.get('RIPPLING_WEBHOOK_DEDUP_TTL', 24 * 3600))
+RIPPLING_WEBHOOK_DEDUP_CACHE_SIZE = int(os.environ.get('RIPPLING_WEBHOOK_DEDUP_CACHE_SIZE', 10000))
+
+# Serve API, webhook and view metrics on /metrics, which is not behind a
+# login: only enable it where the endpoint is not reachable from outside
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'false').lower() == 'true'
+
+# Opt-in per-request profiling of the app views: requests over any budget
+# are logged, and with PROFILING_CPROFILE_DIR set slow ones are profiled
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', 'false').lower() == 'true'
+PROFILING_MAX_QUERIES = int(os.environ.get('PROFILING_MAX_QUERIES', 20))
+PROFILING_MAX_HTTP_REQUESTS = int(os.environ.get('PROFILING_MAX_HTTP_REQUESTS', 5))
+PROFILING_MAX_DURATION = float(os.environ.get('PROFILING_MAX_DURATION', 500))
+PROFILING_CPROFILE_DIR = os.environ.get('PROFILING_CPROFILE_DIR')
+
+# Per-company snapshot of groups shared by bursts of group webhooks
+RIPPLING_GROUP_CACHE_TTL = float(os.environ.get('RIPPLING_GROUP_CACHE_TTL', 60))
+RIPPLING_GROUP_CACHE_MAX_COMPANIES = int(os.environ.get('RIPPLING_GROUP_CACHE_MAX_COMPANIES', 100))
+
+# In-process access token cache
+RIPPLING_TOKEN_EXPIRY_MARGIN = int(os.environ.get('RIPPLING_TOKEN_EXPIRY_MARGIN', 60))
+
+# Proactive token refresh scheduler
+RIPPLING_TOKEN_REFRESH_LEAD = int(os.environ.get('RIPPLING_TOKEN_REFRESH_LEAD', 600))
+RIPPLING_TOKEN_REFRESH_SPREAD = int(os.environ.get('RIPPLING_TOKEN_REFRESH_SPREAD', 600))
+RIPPLING_TOKEN_REFRESH_INTERVAL = float(os.environ.get('RIPPLING_TOKEN_REFRESH_INTERVAL', 60))
+
+# LRU of resolved companies shared by the webhook handlers
+RIPPLING_COMPANY_CACHE_SIZE = int(os.environ.get('RIPPLING_COMPANY_CACHE_SIZE', 1000))
+RIPPLING_COMPANY_CACHE_TTL = float(os.environ.get('RIPPLING_COMPANY_CACHE_TTL', 300))
+
+# Directory query API
+RIPPLING_API_PAGE_SIZE = int(os.environ.get('RIPPLING_API_PAGE_SIZE', 100))
+RIPPLING_API_MAX_PAGE_SIZE = int(os.environ.get('RIPPLING_API_MAX_PAGE_SIZE', 1000))